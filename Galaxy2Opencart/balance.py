@@ -1,27 +1,16 @@
-import requests
 import logging
-from .models import UserAnswer
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import transaction
+from . import client
+from .models import BalanceSnapshot, UserAnswer
 
 logger = logging.getLogger(__name__)
 
-def authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port):
-    erp_auth_path = "/auth"
-    erp_auth_url = f"http://{erp_server_ip}:{erp_server_port}{erp_auth_path}"
-    erp_auth_data = {
-        "username": erp_username,
-        "password": erp_password
-    }
-    response = requests.get(erp_auth_url, params=erp_auth_data)
-    session_cookie = response.cookies.get("ss-id")
-    return session_cookie
-
-def fetch_item_balances_from_erp(session_cookie, erp_server_ip, erp_server_port):
+def fetch_item_balances_from_erp(erp_server_ip, erp_server_port):
     erp_balances_path = "/services/sync/itembalances"
-    erp_balances_url = f"http://{erp_server_ip}:{erp_server_port}{erp_balances_path}"
-    headers = {
-        "Cookie": f"ss-id={session_cookie}"
-    }
-    response = requests.get(erp_balances_url, headers=headers)
+    response = client.erp_get(erp_server_ip, erp_server_port, erp_balances_path)
     item_balances = response.json()
     return item_balances
 
@@ -32,30 +21,93 @@ def transform_balance_for_opencart(balance):
     }
     return transformed_balance
 
+def quantity_key(quantity):
+    """The quantity as sent to OpenCart, so any change to it (also a fractional one) is pushed."""
+    return str(quantity)
+
+
+def read_balance_snapshot():
+    return dict(BalanceSnapshot.objects.values_list('sku', 'quantity'))
+
+
+def changed_balances(balances, snapshot):
+    """Returns the balances whose quantity differs from the last one pushed to OpenCart."""
+    return [balance for balance in balances if snapshot.get(balance["sku"]) != quantity_key(balance["quantity"])]
+
+
+def save_balance_snapshot(balances, snapshot):
+    """Stores the pushed quantities and updates ``snapshot`` in place."""
+    existing = BalanceSnapshot.objects.in_bulk([balance["sku"] for balance in balances if balance["sku"] in snapshot], field_name='sku')
+    to_update = []
+    to_create = []
+    for balance in balances:
+        quantity = quantity_key(balance["quantity"])
+        snapshot[balance["sku"]] = quantity
+        if balance["sku"] in existing:
+            entry = existing[balance["sku"]]
+            entry.quantity = quantity
+            to_update.append(entry)
+        else:
+            to_create.append(BalanceSnapshot(sku=balance["sku"], quantity=quantity))
+    with transaction.atomic():
+        BalanceSnapshot.objects.bulk_update(to_update, ['quantity'], batch_size=500)
+        BalanceSnapshot.objects.bulk_create(to_create, batch_size=500)
+
+
 def get_user_answers_from_db():
     answers = UserAnswer.objects.latest('id')
     return answers
 
-def update_product_quantity_in_opencart(opencart_api_url, balances, opencart_api_key):
+def push_quantity_chunk(update_url, chunk, opencart_api_key, retries):
+    """Sends one chunk of quantities, retrying it on its own. Returns True on success."""
+    headers = {"X-Oc-Restadmin-Id": opencart_api_key}
+    for attempt in range(retries + 1):
+        try:
+            response = client.put(update_url, json=chunk, headers=headers)
+            if response.status_code == 200:
+                return True
+            error = response.text
+        except Exception as e:
+            error = str(e)
+        if attempt < retries:
+            time.sleep(2 ** attempt)
+    logger.error(f"Error updating {len(chunk)} product quantities in OpenCart: {error}")
+    return False
+
+
+def update_product_quantity_in_opencart(opencart_api_url, balances, opencart_api_key, progress=None):
+    """Pushes quantities in chunks of BALANCE_BATCH_SIZE, several chunks in flight at once.
+
+    Returns the SKUs whose chunk could not be written after its retries.
+    """
     # The API endpoint for updating quantities
     update_url = f"{opencart_api_url}/quantitybysku"
-
-    # Set the headers for the request
-    headers = {"X-Oc-Restadmin-Id": opencart_api_key}
+    batch_size = getattr(settings, 'BALANCE_BATCH_SIZE', 500)
+    workers = getattr(settings, 'BALANCE_PUSH_WORKERS', 4)
+    retries = getattr(settings, 'BALANCE_CHUNK_RETRIES', 2)
 
     # Prepare the data for the request. The data should be a list of dictionaries.
-    data = [{"sku": balance["sku"], "quantity": str(balance["quantity"])} for balance in balances]
-
-    # Send a PUT request with the formatted data
-    response = requests.put(update_url, json=data, headers=headers)
-
-    # Check the response and log accordingly
-    if response.status_code == 200:
-        logger.info("Product quantities successfully updated in OpenCart.")
+    data = [{"sku": balance["sku"], "quantity": quantity_key(balance["quantity"])} for balance in balances]
+    chunks = [data[start:start + batch_size] for start in range(0, len(data), batch_size)]
+
+    failed_skus = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for position, (chunk, success) in enumerate(zip(chunks, executor.map(lambda chunk: push_quantity_chunk(update_url, chunk, opencart_api_key, retries), chunks))):
+            if not success:
+                failed_skus.extend(entry["sku"] for entry in chunk)
+            if progress:
+                progress(min(len(data), (position + 1) * batch_size), len(data), len(failed_skus))
+
+    # Check the results and log accordingly
+    if failed_skus:
+        logger.error(f"{len(failed_skus)} of {len(data)} product quantities were not updated in OpenCart: {', '.join(failed_skus[:50])}"
+                     + (" ..." if len(failed_skus) > 50 else ""))
     else:
-        logger.error(f"Error updating product quantities in OpenCart: {response.text}")
+        logger.info(f"{len(data)} product quantities successfully updated in OpenCart in {len(chunks)} chunks.")
+    return failed_skus
 
-def run_import():
+def sync_balances(progress=None):
+    """Runs one stock sync and returns counts of listed, changed, pushed and failed balances."""
     user_answers = get_user_answers_from_db()
 
     store_domain = user_answers.store_domain
@@ -67,19 +119,36 @@ def run_import():
     opencart_api_key = user_answers.opencart_api_key
 
     opencart_api_url = f"https://{store_domain}{store_path}/index.php?route=rest/product_admin/productquantitybysku"
-    print(opencart_api_url)
-    session_cookie = authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port)
+    session_cookie = client.authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port)
+    stats = {"listed": 0, "changed": 0, "pushed": 0, "failed": 0}
 
     if session_cookie:
-        erp_balances = fetch_item_balances_from_erp(session_cookie, erp_server_ip, erp_server_port)
+        erp_balances = fetch_item_balances_from_erp(erp_server_ip, erp_server_port)
 
         if erp_balances:
             transformed_balances = [transform_balance_for_opencart(balance) for balance in erp_balances]
-            update_product_quantity_in_opencart(opencart_api_url, transformed_balances, opencart_api_key)
-            print(transformed_balances)
+            missing = [balance["sku"] for balance in transformed_balances if balance["quantity"] is None]
+            if missing:
+                logger.error(f"{len(missing)} item balances have no quantity and are not pushed: {', '.join(missing[:50])}")
+                transformed_balances = [balance for balance in transformed_balances if balance["quantity"] is not None]
+            snapshot = read_balance_snapshot()
+            changed = changed_balances(transformed_balances, snapshot)
+            stats["listed"] = len(transformed_balances)
+            stats["changed"] = len(changed)
+            logger.info(f"{len(changed)} of {len(transformed_balances)} item balances changed since the last push.")
+            if changed:
+                failed_skus = set(update_product_quantity_in_opencart(opencart_api_url, changed, opencart_api_key, progress))
+                save_balance_snapshot([balance for balance in changed if balance["sku"] not in failed_skus], snapshot)
+                stats["pushed"] = len(changed) - len(failed_skus)
+                stats["failed"] = len(failed_skus)
         else:
             logger.error("No item balances retrieved from ERP.")
 
         logger.info("Balance synchronization completed.")
     else:
         logger.error("Authentication with ERP failed.")
+    return stats
+
+
+def run_import(progress=None):
+    return sync_balances(progress)
@@ -1,29 +1,17 @@
-import requests
+import hashlib
+import json
 import logging
+from collections import defaultdict
+from django.db import transaction
 from django.http import JsonResponse
+from . import client
 from .models import CategoryMapping, UserAnswer
 
 logger = logging.getLogger(__name__)
 
-def authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port):
-    erp_auth_path = "/auth"
-    erp_auth_url = f"http://{erp_server_ip}:{erp_server_port}{erp_auth_path}"
-    erp_auth_data = {
-        "username": erp_username,
-        "password": erp_password
-    }
-    response = requests.get(erp_auth_url, params=erp_auth_data)
-
-    session_cookie = response.cookies.get("ss-id")
-    return session_cookie
-
-def fetch_categories_from_erp(session_cookie, erp_server_ip, erp_server_port):
+def fetch_categories_from_erp(erp_server_ip, erp_server_port):
     erp_categories_path = "/services/sync/itemcategories"
-    erp_categories_url = f"http://{erp_server_ip}:{erp_server_port}{erp_categories_path}"
-    headers = {
-        "Cookie": f"ss-id={session_cookie}"
-    }
-    response = requests.get(erp_categories_url, headers=headers)
+    response = client.erp_get(erp_server_ip, erp_server_port, erp_categories_path)
 
     print("Fetching categories from ERP...")  # Debugging line
     if response.status_code == 200:
@@ -59,60 +47,182 @@ def transform_category_for_opencart(category, categories_mapping, set_parent_id=
     }
     return transformed_category
 
-def update_category_with_parent_id(category, categories_mapping, opencart_api_url, opencart_api_key):
-    parent_id = categories_mapping.get(category["ParentNodeID"])
-    if parent_id is not None:
-        category_id = categories_mapping.get(category["ID"])
-        if category_id is not None:
-            update_url = f"{opencart_api_url}&id={category_id}"
-            updated_category_data = {"parent_id": parent_id}
-            response = requests.put(update_url, headers={"X-Oc-Restadmin-Id": opencart_api_key}, json=updated_category_data)
-
-            if response.status_code == 200:
-                logger.info(f"Updated category {category['Description']} in OpenCart with parent ID {parent_id}.")
-            else:
-                logger.error(f"Error updating category in OpenCart: {response.text}")
+def normalize_category_ids(category):
+    """Returns the category with string ids, as they are stored in CategoryMapping.erp_id."""
+    parent_id = category.get("ParentNodeID")
+    return dict(category, ID=str(category["ID"]), ParentNodeID=str(parent_id) if parent_id is not None else None)
+
+
+def order_categories_parent_first(erp_categories):
+    """Returns the categories so that every parent comes before its children.
+
+    Categories whose parent is not in the list are treated as roots. Categories
+    caught in a parent cycle are appended last and logged.
+    """
+    category_ids = {category["ID"] for category in erp_categories}
+    children = defaultdict(list)
+    ordered = []
+    for category in erp_categories:
+        parent_id = category.get("ParentNodeID")
+        if parent_id is not None and parent_id in category_ids and parent_id != category["ID"]:
+            children[parent_id].append(category)
+        else:
+            ordered.append(category)
+
+    # The list grows while it is walked, so each level is appended after its parents
+    position = 0
+    while position < len(ordered):
+        ordered.extend(children.pop(ordered[position]["ID"], []))
+        position += 1
+
+    if children:
+        cyclic = [category for siblings in children.values() for category in siblings]
+        logger.error(f"{len(cyclic)} categories are part of a parent cycle in the ERP: {', '.join(str(category['ID']) for category in cyclic[:20])}")
+        ordered.extend(cyclic)
+    return ordered
 
 
 def read_categories_mapping():
     mappings = CategoryMapping.objects.all()
     return {mapping.erp_id: mapping.opencart_id for mapping in mappings}
 
-def get_user_answers_from_db():
-    return UserAnswer.objects.latest('id')
 
-def sync_categories(erp_categories, opencart_api_url, opencart_api_key, is_top_level=True):
-    categories_mapping = read_categories_mapping()
+def read_category_snapshot():
+    return {mapping.erp_id: mapping for mapping in CategoryMapping.objects.all()}
 
-    # Step 1: Initially create all categories without setting parent_id
-    for category in erp_categories:
-        erp_id = category["ID"]
-        if CategoryMapping.objects.filter(erp_id=erp_id).exists():
-            logger.info(f"Category with ERP ID {erp_id} already exists in OpenCart. Skipping.")
-            continue
-
-        transformed_category = transform_category_for_opencart(category, categories_mapping, set_parent_id=False)
-        response = requests.post(opencart_api_url, headers={"X-Oc-Restadmin-Id": opencart_api_key}, json=transformed_category)
-
-        if response.status_code == 200:
-            response_data = response.json()
-            opencart_category_id = response_data.get('data', {}).get('id')
-            mapping = CategoryMapping.objects.create(erp_id=erp_id, opencart_id=opencart_category_id)
-            logger.info(f"Category {transformed_category['category_description'][0]['name']} initially created in OpenCart with ID {opencart_category_id}.")
-        else:
-            logger.error(f"Error creating category in OpenCart: {response.text}")
 
-    # Refresh the categories_mapping after initial creation
-    categories_mapping = read_categories_mapping()
+def hash_category(category):
+    """Fingerprint of the category fields pushed to OpenCart, apart from its parent."""
+    payload = json.dumps({"Description": category["Description"], "Code": category["Code"]}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
-    # Step 2: Update categories with their correct parent_id
-    for category in erp_categories:
-        if category.get("ParentNodeID") is not None:
-            update_category_with_parent_id(category, categories_mapping, opencart_api_url, opencart_api_key)
 
+def diff_category_tree(ordered_categories, snapshot):
+    """Compares the ERP tree against the snapshot of the last synced one.
+
+    Returns ``(changes, to_delete)``. ``changes`` holds ``(category, mapping)``
+    pairs in parent-first order, where ``mapping`` is None for a new category and
+    the existing mapping for one that was renamed or moved to another parent.
+    ``to_delete`` holds the mappings of categories gone from the ERP.
+    """
+    changes = []
+    for category in ordered_categories:
+        mapping = snapshot.get(category["ID"])
+        if mapping is None or mapping.content_hash != hash_category(category) or mapping.parent_erp_id != category.get("ParentNodeID"):
+            changes.append((category, mapping))
+    erp_ids = {category["ID"] for category in ordered_categories}
+    to_delete = [mapping for erp_id, mapping in snapshot.items() if erp_id not in erp_ids]
+    return changes, to_delete
+
+def get_user_answers_from_db():
+    return UserAnswer.objects.latest('id')
+
+def save_category_mappings(new_mappings, changed_mappings):
+    with transaction.atomic():
+        CategoryMapping.objects.bulk_create(new_mappings, batch_size=500)
+        CategoryMapping.objects.bulk_update(changed_mappings, ['opencart_id', 'parent_erp_id', 'content_hash'], batch_size=500)
+    new_mappings.clear()
+    changed_mappings.clear()
+
+
+def sync_categories(erp_categories, opencart_api_url, opencart_api_key, is_top_level=True, progress=None):
+    """Pushes only what changed in the ERP tree since the last run, one request per changed category.
+
+    New categories are created parent-first, renamed or moved ones are updated
+    and categories gone from the ERP are deleted from OpenCart. A category that
+    was deleted in OpenCart by hand is created again when it changes.
+    """
+    headers = {"X-Oc-Restadmin-Id": opencart_api_key}
+    erp_categories = [normalize_category_ids(category) for category in erp_categories]
+    snapshot = read_category_snapshot()
+    categories_mapping = {erp_id: mapping.opencart_id for erp_id, mapping in snapshot.items()}
+    # Parents are always created or moved before their children, so the parent id is known up front
+    changes, to_delete = diff_category_tree(order_categories_parent_first(erp_categories), snapshot)
+    if not erp_categories:
+        # An empty tree means the ERP listing failed, not that every category was removed
+        to_delete = []
+    new_count = sum(1 for _, mapping in changes if mapping is None)
+    logger.info(f"Category tree diff: {new_count} to create, {len(changes) - new_count} to update, {len(to_delete)} to delete.")
+
+    total = len(changes) + len(to_delete)
+    new_mappings = []
+    changed_mappings = []
+    counts = {"created": 0, "updated": 0, "deleted": 0, "failed": 0}
+    # Categories that could not be created in this run, their children are left for the next run
+    not_created = set()
+
+    try:
+        for position, (category, mapping) in enumerate(changes):
+            if progress:
+                progress(position, total, counts["failed"])
+            if category.get("ParentNodeID") in not_created:
+                logger.error(f"Category {category['Description']} skipped, its parent could not be created in OpenCart.")
+                if mapping is None:
+                    not_created.add(category["ID"])
+                counts["failed"] += 1
+                continue
+            transformed_category = transform_category_for_opencart(category, categories_mapping)
+            name = transformed_category['category_description'][0]['name']
+            stale_mapping = False
+            if mapping is None:
+                response = client.post(opencart_api_url, headers=headers, json=transformed_category)
+            else:
+                response = client.put(f"{opencart_api_url}&id={mapping.opencart_id}", headers=headers, json=transformed_category)
+                if response.status_code == 404:
+                    # The category was deleted in OpenCart, create it again and keep the mapping under its new id
+                    stale_mapping = True
+                    response = client.post(opencart_api_url, headers=headers, json=transformed_category)
+            creating = mapping is None or stale_mapping
+
+            if response.status_code != 200:
+                logger.error(f"Error {'creating' if creating else 'updating'} category {name} in OpenCart: {response.text}")
+                if creating:
+                    not_created.add(category["ID"])
+                counts["failed"] += 1
+                continue
+            if creating:
+                opencart_category_id = response.json().get('data', {}).get('id')
+                categories_mapping[category["ID"]] = opencart_category_id
+                if mapping is None:
+                    mapping = CategoryMapping(erp_id=category["ID"], opencart_id=opencart_category_id)
+                    new_mappings.append(mapping)
+                else:
+                    mapping.opencart_id = opencart_category_id
+                    changed_mappings.append(mapping)
+                counts["created"] += 1
+                logger.info(f"Category {name} created in OpenCart with ID {opencart_category_id} and parent ID {transformed_category['parent_id']}.")
+            else:
+                changed_mappings.append(mapping)
+                counts["updated"] += 1
+                logger.info(f"Category {name} updated in OpenCart with parent ID {transformed_category['parent_id']}.")
+            mapping.parent_erp_id = category.get("ParentNodeID")
+            mapping.content_hash = hash_category(category)
+            if len(new_mappings) + len(changed_mappings) >= 500:
+                save_category_mappings(new_mappings, changed_mappings)
+
+        deleted_ids = []
+        for position, mapping in enumerate(to_delete, start=len(changes)):
+            if progress:
+                progress(position, total, counts["failed"])
+            response = client.delete(f"{opencart_api_url}&id={mapping.opencart_id}", headers=headers)
+            # A category already removed in OpenCart only needs its mapping dropped
+            if response.status_code in (200, 404):
+                deleted_ids.append(mapping.erp_id)
+                counts["deleted"] += 1
+                logger.info(f"Category with ERP ID {mapping.erp_id} deleted from OpenCart.")
+            else:
+                logger.error(f"Error deleting category {mapping.opencart_id} from OpenCart: {response.text}")
+                counts["failed"] += 1
+        CategoryMapping.objects.filter(erp_id__in=deleted_ids).delete()
+    finally:
+        # Keep the ids of categories already created even if the run is interrupted
+        save_category_mappings(new_mappings, changed_mappings)
+
+    logger.info(f"Categories synchronized: {counts['created']} created, {counts['updated']} updated, {counts['deleted']} deleted, {counts['failed']} failed.")
+    return counts
 
 
-def run_import():
+def run_import(progress=None):
     print("Starting import process...")  # Debugging line
 
     user_answers = get_user_answers_from_db()
@@ -126,16 +236,16 @@ def run_import():
     erp_password = user_answers.erp_password
     opencart_api_key = user_answers.opencart_api_key
 
-    session_cookie = authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port)
+    session_cookie = client.authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port)
     opencart_api_url = f"https://{store_domain}{store_path}/index.php?route=rest/category_admin/category"
 
     if session_cookie:
-        erp_categories = fetch_categories_from_erp(session_cookie, erp_server_ip, erp_server_port)
+        erp_categories = fetch_categories_from_erp(erp_server_ip, erp_server_port)
         print(f"Fetched {len(erp_categories)} categories from ERP.")  # Debugging line
 
         # Call the sync_categories function
         print("Calling sync_categories function...")  # Debugging line
-        sync_categories(erp_categories, opencart_api_url, opencart_api_key)
+        sync_categories(erp_categories, opencart_api_url, opencart_api_key, progress=progress)
 
         logger.info("Categories synchronization completed.")
     else:
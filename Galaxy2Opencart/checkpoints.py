@@ -0,0 +1,62 @@
+import logging
+import time
+from django.conf import settings
+from django.db import transaction
+from .models import SyncCheckpoint
+
+logger = logging.getLogger(__name__)
+
+
+def read_checkpoint(name, default=None):
+    checkpoint = SyncCheckpoint.objects.filter(name=name).first()
+    return checkpoint.revision_number if checkpoint else default
+
+
+def write_checkpoint(name, revision_number):
+    SyncCheckpoint.objects.update_or_create(name=name, defaults={'revision_number': str(revision_number)})
+
+
+class CheckpointWriter:
+    """Buffers watermark advances and commits them in batches.
+
+    The watermark is written every ``batch_size`` advances or ``interval`` seconds,
+    whichever comes first, and once more when the writer is closed. Each write runs
+    ``before_flush`` in the same transaction, so state that must not outlive the
+    watermark is committed together with it. After a crash a run resumes from the
+    last committed watermark and at most one batch of items is pushed again, so
+    anything that must not be repeated (e.g. creating a product) has to be saved
+    right away instead of in ``before_flush``.
+    """
+
+    def __init__(self, name, batch_size=None, interval=None, before_flush=None):
+        self.name = name
+        self.batch_size = batch_size or getattr(settings, 'SYNC_CHECKPOINT_BATCH_SIZE', 200)
+        self.interval = interval or getattr(settings, 'SYNC_CHECKPOINT_INTERVAL', 5)
+        self.before_flush = before_flush
+        self.revision_number = None
+        self.pending = 0
+        self.writes = 0
+        self.last_flush = time.monotonic()
+
+    def advance(self, revision_number):
+        self.revision_number = revision_number
+        self.pending += 1
+        if self.pending >= self.batch_size or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        with transaction.atomic():
+            if self.before_flush:
+                self.before_flush()
+            if self.pending:
+                write_checkpoint(self.name, self.revision_number)
+                self.writes += 1
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        return False
@@ -0,0 +1,320 @@
+import itertools
+import json
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Defaults used when settings.HTTP_CLIENT does not override them
+DEFAULT_HTTP_CLIENT = {
+    "pool_connections": 10,
+    "pool_maxsize": 20,
+    "connect_timeout": 10,
+    "read_timeout": 120,
+    "retries": 3,
+    "backoff_factor": 0.5,
+    "status_forcelist": (502, 503, 504),
+    "erp_session_ttl": 1200,
+    "rate_limit": 0,
+    "rate_limits": {},
+}
+
+_session = None
+_session_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+_erp_sessions = {}
+_erp_sessions_lock = threading.Lock()
+
+
+def get_client_settings():
+    client_settings = dict(DEFAULT_HTTP_CLIENT)
+    client_settings.update(getattr(settings, "HTTP_CLIENT", {}))
+    return client_settings
+
+
+def _count(host, key):
+    with _stats_lock:
+        counters = _stats.setdefault(host, {"requests": 0, "connections": 0})
+        counters[key] += 1
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count(f"{self.host}:{self.port}", "connections")
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count(f"{self.host}:{self.port}", "connections")
+        return super()._new_conn()
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that records how often pooled connections are reused per host."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        _count(f"{parts.hostname}:{port}", "requests")
+        return super().send(request, **kwargs)
+
+
+def build_session():
+    client_settings = get_client_settings()
+    retry = Retry(
+        total=client_settings["retries"],
+        backoff_factor=client_settings["backoff_factor"],
+        status_forcelist=client_settings["status_forcelist"],
+        raise_on_status=False,
+    )
+    adapter = CountingHTTPAdapter(
+        pool_connections=client_settings["pool_connections"],
+        pool_maxsize=client_settings["pool_maxsize"],
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session()
+    return _session
+
+
+def reset_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+    with _stats_lock:
+        _stats.clear()
+
+
+class RateLimiter:
+    """Spaces out requests to one host so at most ``rate`` start per second across all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def get_rate_limiter(host, client_settings):
+    rate = client_settings["rate_limits"].get(host, client_settings["rate_limit"])
+    if not rate:
+        return None
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(host)
+        if limiter is None:
+            limiter = _rate_limiters[host] = RateLimiter(rate)
+        return limiter
+
+
+def request(method, url, **kwargs):
+    client_settings = get_client_settings()
+    if "timeout" not in kwargs:
+        kwargs["timeout"] = (client_settings["connect_timeout"], client_settings["read_timeout"])
+    limiter = get_rate_limiter(urlsplit(url).hostname, client_settings)
+    if limiter:
+        limiter.wait()
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
+
+
+def iter_json_array(response, chunk_size=65536):
+    """Yields the elements of a top-level JSON array from a streamed response.
+
+    Only the element being decoded and one chunk are held in memory, so large
+    ERP listings can be processed while they are still downloading.
+    """
+    decoder = json.JSONDecoder()
+    if response.encoding is None:
+        response.encoding = "utf-8"
+    buffer = ""
+    position = 0
+    started = False
+    # None marks the end of the stream
+    for chunk in itertools.chain(response.iter_content(chunk_size=chunk_size, decode_unicode=True), [None]):
+        buffer = buffer[position:] + (chunk or "")
+        position = 0
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or (started and buffer[position] == ",")):
+                position += 1
+            if position >= len(buffer):
+                break
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError("Expected a JSON array in the response body.")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break
+            if chunk is not None and (end == len(buffer) or buffer[end] not in " \t\r\n,]"):
+                # A number cut off by the chunk boundary (e.g. "12" of 123 or "6." of 6.5)
+                # also decodes, so an element only counts once a delimiter follows it
+                break
+            position = end
+            yield element
+    # Reaching the end of the stream means the closing bracket never arrived
+    if started or buffer[position:].strip():
+        raise ValueError("Truncated JSON array in the response body.")
+
+
+def connection_stats():
+    """Returns per-host request and connection counters of the shared pools.
+
+    ``reused`` is the number of requests served over an already open
+    connection, i.e. the TCP/TLS handshakes that were avoided.
+    """
+    with _stats_lock:
+        return {
+            host: dict(counters, reused=counters["requests"] - counters["connections"])
+            for host, counters in _stats.items()
+        }
+
+
+def log_connection_stats():
+    for host, counters in connection_stats().items():
+        logger.info(f"{host}: {counters['requests']} requests over {counters['connections']} connections ({counters['reused']} reused).")
+
+
+def erp_url(erp_server_ip, erp_server_port, path):
+    return f"http://{erp_server_ip}:{erp_server_port}{path}"
+
+
+def login_to_erp(erp_username, erp_password, erp_server_ip, erp_server_port):
+    erp_auth_url = erp_url(erp_server_ip, erp_server_port, "/auth")
+    erp_auth_data = {
+        "username": erp_username,
+        "password": erp_password
+    }
+
+    try:
+        response = get(erp_auth_url, params=erp_auth_data)
+        response.raise_for_status()
+        session_cookie = response.cookies.get("ss-id")
+        return session_cookie
+    except Exception as e:
+        logger.error(f"Error during ERP authentication: {e}")
+        return None
+
+
+def authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port):
+    """Returns the process-wide cached ERP ``ss-id`` cookie, logging in only when needed.
+
+    The cookie is shared by every sync module talking to the same ERP server and
+    is renewed once it is older than ``erp_session_ttl`` seconds or after the
+    ERP answers 401 (see ``erp_request``).
+    """
+    key = (str(erp_server_ip), str(erp_server_port))
+    with _erp_sessions_lock:
+        cached = _erp_sessions.get(key)
+        if cached and cached["username"] == erp_username and cached["password"] == erp_password \
+                and cached["cookie"] and cached["expires_at"] > time.monotonic():
+            return cached["cookie"]
+
+        session_cookie = login_to_erp(erp_username, erp_password, erp_server_ip, erp_server_port)
+        _erp_sessions[key] = {
+            "username": erp_username,
+            "password": erp_password,
+            "cookie": session_cookie,
+            "expires_at": time.monotonic() + get_client_settings()["erp_session_ttl"],
+        }
+        return session_cookie
+
+
+def invalidate_erp_session(erp_server_ip, erp_server_port, session_cookie=None):
+    """Drops the cached cookie, or only ``session_cookie`` if another thread has not renewed it yet."""
+    key = (str(erp_server_ip), str(erp_server_port))
+    with _erp_sessions_lock:
+        cached = _erp_sessions.get(key)
+        if cached and (session_cookie is None or cached["cookie"] == session_cookie):
+            cached["cookie"] = None
+
+
+def erp_request(method, erp_server_ip, erp_server_port, path, **kwargs):
+    """Sends a request to the ERP with the cached session cookie.
+
+    A 401 response invalidates the cookie, triggers a single re-authentication
+    with the credentials of the last login and retries the request once.
+    """
+    key = (str(erp_server_ip), str(erp_server_port))
+    with _erp_sessions_lock:
+        credentials = _erp_sessions.get(key)
+    if credentials is None:
+        raise RuntimeError(f"No ERP session for {erp_server_ip}:{erp_server_port}; call authenticate_with_erp first.")
+
+    headers = dict(kwargs.pop("headers", None) or {})
+    url = erp_url(erp_server_ip, erp_server_port, path)
+    for attempt in range(2):
+        session_cookie = authenticate_with_erp(credentials["username"], credentials["password"], erp_server_ip, erp_server_port)
+        headers["Cookie"] = f"ss-id={session_cookie}"
+        response = request(method, url, headers=headers, **kwargs)
+        if response.status_code != 401 or attempt:
+            return response
+        logger.info("ERP session expired, re-authenticating.")
+        response.close()
+        invalidate_erp_session(erp_server_ip, erp_server_port, session_cookie)
+    return response
+
+
+def erp_get(erp_server_ip, erp_server_port, path, **kwargs):
+    return erp_request("GET", erp_server_ip, erp_server_port, path, **kwargs)
+
+
+def erp_post(erp_server_ip, erp_server_port, path, **kwargs):
+    return erp_request("POST", erp_server_ip, erp_server_port, path, **kwargs)
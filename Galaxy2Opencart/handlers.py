@@ -1,17 +1,271 @@
-import logging
+import atexit
 import json
+import logging
+import os
+import queue
+import threading
+import time
+import weakref
+
+_handlers = weakref.WeakSet()
+
 
 class JsonFileLogHandler(logging.Handler):
-    def __init__(self, filename):
+    """Writes log records as JSON lines from a background thread.
+
+    ``emit`` only puts the record on a queue of at most ``buffer_size`` entries,
+    so logging never waits on the disk; when the buffer is full records are
+    dropped and counted. The writer thread keeps the file open and writes
+    whatever is queued in one batch at least every ``flush_interval`` seconds.
+    The file is rotated once it grows past ``max_bytes`` or when its last write
+    lies in an earlier ``rotate_interval`` period (counted from the epoch, so a
+    daily interval rotates at midnight UTC), keeping ``backup_count`` old files
+    (``logs.json.1`` is the newest). Zero disables either kind of rotation.
+    Size and age come from the file itself and a lock file guards the renames,
+    so several processes writing the same log rotate it only once.
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5, rotate_interval=0,
+                 buffer_size=10000, flush_interval=0.5):
         super().__init__()
         self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_interval = rotate_interval
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.dropped = 0
+        self.stream = None
+        self.write_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.writer = threading.Thread(target=self._run, name="json-log-writer", daemon=True)
+        self.writer.start()
+        _handlers.add(self)
 
     def emit(self, record):
-        log_entry = {
-            "level": record.levelname,
-            "message": record.getMessage(),
-            "module": record.module,
-        }
-        
-        with open(self.filename, 'a') as f:
-            f.write(json.dumps(log_entry) + '\n')
\ No newline at end of file
+        try:
+            log_entry = {
+                "level": record.levelname,
+                "message": record.getMessage(),
+                "module": record.module,
+            }
+            self.queue.put_nowait(log_entry)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        while not self.stopping.is_set() or not self.queue.empty():
+            try:
+                entries = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(entries)
+
+    def _write(self, entries):
+        with self.write_lock:
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                entries.append({"level": "WARNING", "message": f"{dropped} log records dropped, the log buffer was full.", "module": "handlers"})
+            try:
+                self._open()
+                if self._should_rotate():
+                    self._rotate()
+                    self._open()
+                self.stream.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+                self.stream.flush()
+            except OSError:
+                self._close_stream()
+
+    def _open(self):
+        if self.stream is not None:
+            # The file may have been deleted or rotated by another process, write to the new one then
+            try:
+                if os.stat(self.filename).st_ino == os.fstat(self.stream.fileno()).st_ino:
+                    return
+            except OSError:
+                pass
+            self._close_stream()
+        self.stream = open(self.filename, 'a')
+
+    def _close_stream(self):
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except OSError:
+                pass
+            self.stream = None
+
+    def _should_rotate(self):
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        if self.max_bytes and stat.st_size >= self.max_bytes:
+            return True
+        return bool(self.rotate_interval) and stat.st_size > 0 \
+            and int(stat.st_mtime // self.rotate_interval) < int(time.time() // self.rotate_interval)
+
+    def _rotate(self):
+        self._close_stream()
+        lock_path = f"{self.filename}.lock"
+        try:
+            lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Another process is rotating; a lock left behind by a crashed one is cleared after a minute
+            try:
+                if time.time() - os.stat(lock_path).st_mtime > 60:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            return
+        except OSError:
+            return
+        try:
+            # The file may have been rotated by another process since the first check
+            if not self._should_rotate():
+                return
+            if self.backup_count > 0:
+                for index in range(self.backup_count - 1, 0, -1):
+                    source = f"{self.filename}.{index}"
+                    if os.path.exists(source):
+                        os.replace(source, f"{self.filename}.{index + 1}")
+                os.replace(self.filename, f"{self.filename}.1")
+            else:
+                os.remove(self.filename)
+        except OSError:
+            # e.g. a file still open in another process on Windows, keep writing to the current one
+            pass
+        finally:
+            os.close(lock)
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+    def truncate(self):
+        """Empties the log file, dropping entries still waiting in the buffer."""
+        with self.write_lock:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._close_stream()
+            open(self.filename, 'w').close()
+
+    def flush(self):
+        """Waits until everything queued so far has been written."""
+        deadline = time.monotonic() + 5
+        while not self.queue.empty() and self.writer.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with self.write_lock:
+            if self.stream is not None:
+                self.stream.flush()
+
+    def close(self):
+        self.stopping.set()
+        if self.writer.is_alive():
+            self.writer.join(timeout=5)
+        with self.write_lock:
+            self._close_stream()
+        _handlers.discard(self)
+        super().close()
+
+
+def clear_log_file(filename):
+    """Empties a JSON log file, also through the handlers of this process that keep it open."""
+    path = os.path.abspath(filename)
+    handlers = [handler for handler in list(_handlers) if os.path.abspath(handler.filename) == path]
+    for handler in handlers:
+        handler.truncate()
+    if not handlers and os.path.exists(filename):
+        os.remove(filename)
+
+
+@atexit.register
+def _close_handlers():
+    for handler in list(_handlers):
+        handler.close()
+
+
+def _log_cursor(stat, offset):
+    # The inode tells a rotated or recreated file apart from the one the cursor was taken on
+    return f"{stat.st_ino}:{offset}"
+
+
+def _parse_log_cursor(cursor):
+    file_id, _, offset = (cursor or '').rpartition(':')
+    try:
+        return file_id, int(offset)
+    except ValueError:
+        return None, None
+
+
+def _matches(entry, levels, modules):
+    return (not levels or entry.get("level") in levels) and (not modules or entry.get("module") in modules)
+
+
+def _parse_lines(data, levels, modules):
+    entries = []
+    for line in data.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if _matches(entry, levels, modules):
+            entries.append(entry)
+    return entries
+
+
+def read_log_entries(filename, cursor=None, limit=200, levels=None, modules=None, max_bytes=1024 * 1024):
+    """Returns the log entries written after ``cursor``, reading at most ``max_bytes`` of the file.
+
+    Without a cursor the last ``limit`` entries are returned. The result holds
+    the matching ``entries``, the ``cursor`` to send with the next call, ``more``
+    when entries are left to read right away and ``reset`` when the file was
+    cleared or rotated since the cursor was taken and reading started over.
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return {"entries": [], "cursor": None, "more": False, "reset": cursor is not None}
+    file_id, offset = _parse_log_cursor(cursor)
+
+    with open(filename, 'rb') as f:
+        if offset is None:
+            # Tail: only the end of the file is read, however large it is
+            start = max(0, stat.st_size - max_bytes)
+            f.seek(start)
+            data = f.read(stat.st_size - start)
+            if start:
+                data = data[data.find(b'\n') + 1:]
+                start = stat.st_size - len(data)
+            data = data[:data.rfind(b'\n') + 1]
+            entries = _parse_lines(data, levels, modules)[-limit:]
+            return {"entries": entries, "cursor": _log_cursor(stat, start + len(data)), "more": False, "reset": False}
+
+        reset = file_id != str(stat.st_ino) or offset > stat.st_size
+        if reset:
+            offset = 0
+        f.seek(offset)
+        entries = []
+        read = 0
+        more = False
+        while True:
+            if len(entries) >= limit or read >= max_bytes:
+                more = True
+                break
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                # End of file, or a line the writer has not finished yet
+                break
+            read += len(line)
+            entries.extend(_parse_lines(line, levels, modules))
+        return {"entries": entries, "cursor": _log_cursor(stat, offset + read), "more": more, "reset": reset}
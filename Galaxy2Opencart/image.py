@@ -1,105 +1,81 @@
-import requests
 import base64
+import hashlib
 import logging
-import mimetypes
-import tempfile
-import os
-from .models import UserAnswer
+import multiprocessing
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.db import transaction
+from . import client, imaging, itemcodes
+from .checkpoints import read_checkpoint, write_checkpoint
+from .pipeline import Pipeline
+from .models import ImageLedger, UserAnswer
 
 logger = logging.getLogger(__name__)
 
-def authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port):
-    erp_auth_path = "/auth"
-    erp_auth_url = f"http://{erp_server_ip}:{erp_server_port}{erp_auth_path}"
-    erp_auth_data = {
-        "username": erp_username,
-        "password": erp_password
-    }
-    response = requests.get(erp_auth_url, params=erp_auth_data)
-    session_cookie = response.cookies.get("ss-id")
-    return session_cookie
-
-def fetch_image_info_from_erp(session_cookie, erp_server_ip, erp_server_port):
+def fetch_image_info_from_erp(erp_server_ip, erp_server_port, last_revision_number=None):
     erp_images_path = "/services/sync/itemimages"
-    erp_images_url = f"http://{erp_server_ip}:{erp_server_port}{erp_images_path}"
-    headers = {
-        "Cookie": f"ss-id={session_cookie}"
-    }
-    response = requests.get(erp_images_url, headers=headers)
+    params = {}
+    if last_revision_number is not None:
+        params["RevisionNumber"] = last_revision_number
+    response = client.erp_get(erp_server_ip, erp_server_port, erp_images_path, params=params)
     image_info = response.json()
     return image_info
 
-def retrieve_image_from_erp(session_cookie, erp_server_ip, erp_server_port, image_id):
-    erp_image_url = f"http://{erp_server_ip}:{erp_server_port}/api/glx/entities/itemimage/{image_id}"
-    headers = {
-        "Cookie": f"ss-id={session_cookie}"
-    }
-    response = requests.get(erp_image_url, headers=headers)
+def retrieve_image_from_erp(erp_server_ip, erp_server_port, image_id):
+    erp_image_path = f"/api/glx/entities/itemimage/{image_id}"
+    response = client.erp_get(erp_server_ip, erp_server_port, erp_image_path)
     image_data = response.json()["Image"]
     return image_data
 
-def get_sku_from_erp(session_cookie, erp_server_ip, erp_server_port, item_id):
-    erp_item_url = f"http://{erp_server_ip}:{erp_server_port}/api/glx/entities/item/fetch"
-    headers = {
-        "Cookie": f"ss-id={session_cookie}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "SelectProperties": ["ID", "LightCrmCode"],
-        "Filters": [
-            {
-                "Name": "ID",
-                "Type": "Default",
-                "Operator": "Equal",
-                "Value": item_id
-            }
-        ]
-    }
-    response = requests.post(erp_item_url, headers=headers, json=data)
-    item_data = response.json()
-    
-    if item_data:
-        sku = item_data[0].get("LightCrmCode")
-        return sku
-    else:
-        return None
+def get_sku_from_erp(erp_server_ip, erp_server_port, item_id):
+    return itemcodes.resolve_skus(erp_server_ip, erp_server_port, [item_id]).get(str(item_id))
+
+# Magic bytes of the image formats the ERP stores, with their file extension and MIME type
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png", "image/png"),
+    (b"\xff\xd8\xff", "jpg", "image/jpeg"),
+    (b"GIF87a", "gif", "image/gif"),
+    (b"GIF89a", "gif", "image/gif"),
+    (b"BM", "bmp", "image/bmp"),
+]
+
+
+def detect_image_format(image_bytes):
+    """Returns ``(extension, mime_type)`` of the image, detected from its leading bytes."""
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    for signature, extension, mime_type in IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return extension, mime_type
+    return "jpg", "image/jpeg"  # Default MIME type
+
 
 def upload_image_to_opencart(opencart_api_url, product_id, image_data, opencart_api_key):
     """Uploads an image to OpenCart for the specified product."""
-    # Convert the base64 image data to bytes
-    image_bytes = base64.b64decode(image_data)
-
-    # Create a temporary file with the image data
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_image_file:
-        temp_image_file.write(image_bytes)
-        temp_image_path = temp_image_file.name
-
-    # Determine the MIME type of the image
-    mime_type, _ = mimetypes.guess_type(temp_image_path)
-    if mime_type is None:
-        mime_type = 'image/jpeg'  # Default MIME type
-
-    # Prepare the file for upload
-    with open(temp_image_path, 'rb') as image_file:
-        files = {'file': (os.path.basename(temp_image_path), image_file, mime_type)}
-        headers = {"X-Oc-Restadmin-Id": opencart_api_key}
-        url = f"{opencart_api_url}/productimages&id={product_id}"
-        print(url)
-        # Send POST request to API endpoint
-        response = requests.post(url, files=files, headers=headers)
-    # Remove the temporary file
-    os.remove(temp_image_path)
+    # Convert the base64 image data to bytes, the multipart body is built from them in memory
+    image_bytes = base64.b64decode(image_data) if isinstance(image_data, str) else image_data
+    extension, mime_type = detect_image_format(image_bytes)
+
+    files = {'file': (f"{product_id}_{uuid.uuid4().hex[:8]}.{extension}", image_bytes, mime_type)}
+    headers = {"X-Oc-Restadmin-Id": opencart_api_key}
+    url = f"{opencart_api_url}/productimages&id={product_id}"
+    # Send POST request to API endpoint
+    response = client.post(url, files=files, headers=headers)
 
     # Process response and handle errors
     if response.status_code == 200:
         logger.info(f"Image uploaded successfully for product ID {product_id}")
+        return True
     else:
         logger.error(f"Failed to upload image for product ID {product_id}: {response.text}")
+        return False
 
 
 def get_opencart_product_id_by_sku(opencart_api_url, sku, opencart_api_key):
     request_url = f"{opencart_api_url}/getproductidbyparameter&p=sku&value={sku}"
-    response = requests.get(request_url, headers={"X-Oc-Restadmin-Id": opencart_api_key})
+    response = client.get(request_url, headers={"X-Oc-Restadmin-Id": opencart_api_key})
 
     if response.status_code == 200:
         response_data = response.json()
@@ -108,37 +84,210 @@ def get_opencart_product_id_by_sku(opencart_api_url, sku, opencart_api_key):
         else:
             return None
     else:
-        logger.error(f"Unsuccessful response from API: Status Code {response.status_code}")
-        return None
+        # Not the same as an unknown SKU, the image must be tried again on the next run
+        raise RuntimeError(f"Unsuccessful response from API: Status Code {response.status_code}")
+
+def read_image_ledger():
+    return {
+        entry.erp_image_id: entry
+        for entry in ImageLedger.objects.only('erp_image_id', 'content_hash', 'opencart_product_id', 'revision_number')
+    }
+
+
+def image_revision(image_info):
+    revision_number = image_info.get("RevisionNumber")
+    return str(revision_number) if revision_number is not None else ''
+
+
+def is_image_unchanged(image_info, ledger):
+    """An image listed with the same ERP revision as its ledger entry needs no transfer at all.
+
+    Images listed without a revision are always downloaded and left to the
+    content hash comparison.
+    """
+    revision_number = image_revision(image_info)
+    if not revision_number:
+        return False
+    entry = ledger.get(str(image_info["ID"]))
+    return entry is not None and entry.revision_number == revision_number
+
+
+def image_processing_enabled():
+    if not getattr(settings, 'IMAGE_PROCESS_ENABLED', False):
+        return False
+    if not imaging.PILLOW_AVAILABLE:
+        logger.error("Image processing is enabled but Pillow is not installed, uploading original images.")
+        return False
+    return True
+
+
+def revision_key(revision_number):
+    try:
+        return int(revision_number)
+    except (TypeError, ValueError):
+        return -1
+
+
+def next_image_watermark(erp_images, done_ids, last_revision_number):
+    """Highest revision up to which every listed image has been synced."""
+    watermark = last_revision_number
+    for image_info in sorted(erp_images, key=lambda info: revision_key(info.get("RevisionNumber"))):
+        if image_info.get("RevisionNumber") is None or str(image_info["ID"]) not in done_ids:
+            break
+        watermark = image_info["RevisionNumber"]
+    return watermark
+
+
+class ImageLedgerWriter:
+    """Collects ledger rows from the upload workers and writes them in batches from one thread at a time."""
+
+    def __init__(self, batch_size=50):
+        self.batch_size = batch_size
+        self.pending = []
+        self.done_ids = set()
+        self.lock = threading.Lock()
+
+    def skip(self, image_info):
+        """Counts an image that cannot be uploaded (its product is unknown) as done for the watermark."""
+        with self.lock:
+            self.done_ids.add(str(image_info["ID"]))
+
+    def record(self, image_info, content_hash, opencart_product_id):
+        with self.lock:
+            self.done_ids.add(str(image_info["ID"]))
+            self.pending.append(ImageLedger(
+                erp_image_id=str(image_info["ID"]),
+                content_hash=content_hash,
+                opencart_product_id=opencart_product_id,
+                revision_number=image_revision(image_info),
+            ))
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        with transaction.atomic():
+            ImageLedger.objects.filter(erp_image_id__in=[entry.erp_image_id for entry in self.pending]).delete()
+            ImageLedger.objects.bulk_create(self.pending)
+        self.pending = []
+
 
 def get_user_answers_from_db():
     answers = UserAnswer.objects.latest('id')
     return answers
 
-def run_import():
+def run_import(progress=None):
     user_answers = get_user_answers_from_db()
     opencart_api_url = f"https://{user_answers.store_domain}{user_answers.store_path}/index.php?route=rest/product_admin"
     opencart_api_key = user_answers.opencart_api_key
-    session_cookie = authenticate_with_erp(user_answers.erp_username, user_answers.erp_password, user_answers.erp_server_ip, user_answers.erp_server_port)
+    session_cookie = client.authenticate_with_erp(user_answers.erp_username, user_answers.erp_password, user_answers.erp_server_ip, user_answers.erp_server_port)
 
     if session_cookie:
-        erp_images = fetch_image_info_from_erp(session_cookie, user_answers.erp_server_ip, user_answers.erp_server_port)
+        itemcodes.forget_unknown_item_codes()
+        last_revision_number = read_checkpoint('images')
+        listed_images = fetch_image_info_from_erp(user_answers.erp_server_ip, user_answers.erp_server_port, last_revision_number)
 
-        if erp_images:
-            for image_info in erp_images:
-                item_id = image_info["ItemID"]
-                sku = get_sku_from_erp(session_cookie, user_answers.erp_server_ip, user_answers.erp_server_port, item_id)
-
-                if sku:
-                    opencart_product_id = get_opencart_product_id_by_sku(opencart_api_url, sku, opencart_api_key)
-                    if opencart_product_id:
-                        image_data = retrieve_image_from_erp(session_cookie, user_answers.erp_server_ip, user_answers.erp_server_port, image_info["ID"])
-                        upload_image_to_opencart(opencart_api_url, opencart_product_id, image_data, opencart_api_key)
-                    else:
-                        logger.error(f"SKU '{sku}' not found in OpenCart.")
+        if listed_images:
+            ledger = read_image_ledger()
+            ledger_writer = ImageLedgerWriter()
+            logger.info(f"{len(listed_images)} images listed since revision {last_revision_number}.")
+            erp_images = []
+            for image_info in listed_images:
+                if is_image_unchanged(image_info, ledger):
+                    ledger_writer.done_ids.add(str(image_info["ID"]))
                 else:
+                    erp_images.append(image_info)
+            logger.info(f"{len(listed_images) - len(erp_images)} of {len(listed_images)} images are unchanged since their last upload.")
+
+            # Resolve all item codes up front in a few batched ERP requests
+            skus = itemcodes.resolve_skus(user_answers.erp_server_ip, user_answers.erp_server_port, {image_info["ItemID"] for image_info in erp_images})
+
+            def resolve(image_info):
+                item_id = image_info["ItemID"]
+                sku = skus.get(str(item_id))
+                # Images of unknown products are skipped for good, a new image revision lists them again
+                if not sku:
                     logger.error(f"Could not find SKU for item ID '{item_id}' in ERP.")
+                    ledger_writer.skip(image_info)
+                    return None
+                opencart_product_id = get_opencart_product_id_by_sku(opencart_api_url, sku, opencart_api_key)
+                if not opencart_product_id:
+                    logger.error(f"SKU '{sku}' not found in OpenCart.")
+                    ledger_writer.skip(image_info)
+                    return None
+                return image_info, opencart_product_id
+
+            def download(resolved):
+                image_info, opencart_product_id = resolved
+                image_data = retrieve_image_from_erp(user_answers.erp_server_ip, user_answers.erp_server_port, image_info["ID"])
+                image_bytes = base64.b64decode(image_data)
+                content_hash = hashlib.sha256(image_bytes).hexdigest()
+                entry = ledger.get(str(image_info["ID"]))
+                if entry and entry.content_hash == content_hash and entry.opencart_product_id == int(opencart_product_id):
+                    # Same picture under a new revision, only remember the revision
+                    ledger_writer.record(image_info, content_hash, entry.opencart_product_id)
+                    return None
+                return image_info, opencart_product_id, image_bytes, content_hash
+
+            def process(downloaded):
+                image_info, opencart_product_id, image_bytes, content_hash = downloaded
+                # CPU-bound work runs in the process pool, the stage thread only waits for it
+                try:
+                    processed_bytes = process_pool.submit(
+                        imaging.process_image,
+                        image_bytes,
+                        getattr(settings, 'IMAGE_MAX_DIMENSION', 1600),
+                        getattr(settings, 'IMAGE_OUTPUT_FORMAT', 'JPEG'),
+                        getattr(settings, 'IMAGE_QUALITY', 85),
+                    ).result()
+                except Exception as e:
+                    # Processing is optional, an image it cannot handle is uploaded as it came from the ERP
+                    logger.warning(f"Could not process image {image_info['ID']}, uploading the original: {e}")
+                    processed_bytes = image_bytes
+                return image_info, opencart_product_id, processed_bytes, content_hash
+
+            def upload(downloaded):
+                image_info, opencart_product_id, image_bytes, content_hash = downloaded
+                if not upload_image_to_opencart(opencart_api_url, opencart_product_id, image_bytes, opencart_api_key):
+                    upload_failures.append(image_info["ID"])
+                    return None
+                ledger_writer.record(image_info, content_hash, int(opencart_product_id))
+                return True
+
+            unchanged = len(listed_images) - len(erp_images)
+            upload_failures = []
+            on_item_done = (lambda done, failed: progress(unchanged + done, len(listed_images), failed + len(upload_failures))) if progress else None
+            image_pipeline = Pipeline("Images", queue_size=getattr(settings, 'IMAGE_QUEUE_SIZE', 16), log=logger, on_item_done=on_item_done)
+            image_pipeline.add_stage("resolve", resolve, getattr(settings, 'IMAGE_RESOLVE_WORKERS', 4))
+            image_pipeline.add_stage("download", download, getattr(settings, 'IMAGE_DOWNLOAD_WORKERS', 4))
+            process_pool = None
+            if image_processing_enabled():
+                process_workers = getattr(settings, 'IMAGE_PROCESS_WORKERS', 2)
+                # Forking now would copy the state of the pipeline, log writer and lock heartbeat threads
+                process_pool = ProcessPoolExecutor(max_workers=process_workers, mp_context=multiprocessing.get_context("spawn"))
+                image_pipeline.add_stage("process", process, process_workers)
+            image_pipeline.add_stage("upload", upload, getattr(settings, 'IMAGE_UPLOAD_WORKERS', 4))
+            try:
+                image_pipeline.run(erp_images)
+            finally:
+                ledger_writer.flush()
+                if process_pool:
+                    process_pool.shutdown()
+            image_pipeline.log_stats()
+
+            watermark = next_image_watermark(listed_images, ledger_writer.done_ids, last_revision_number)
+            if watermark is not None and watermark != last_revision_number:
+                write_checkpoint('images', watermark)
+                logger.info(f"Image revision watermark advanced to {watermark}.")
+        elif last_revision_number is not None:
+            logger.info(f"No images changed since revision {last_revision_number}.")
         else:
             logger.error("No images retrieved from ERP.")
+        client.log_connection_stats()
     else:
         logger.error("Authentication with ERP failed.")
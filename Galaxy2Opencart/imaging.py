@@ -0,0 +1,48 @@
+"""Image resizing and recompression for the image sync.
+
+Runs inside worker processes, so it must not import Django models. Pillow is
+optional; without it ``PILLOW_AVAILABLE`` is False and images are uploaded as
+they come from the ERP.
+"""
+from io import BytesIO
+
+try:
+    from PIL import Image
+    PILLOW_AVAILABLE = True
+except ImportError:
+    Image = None
+    PILLOW_AVAILABLE = False
+
+
+def process_image(image_bytes, max_dimension, output_format, quality):
+    """Shrinks the image to fit ``max_dimension`` and re-encodes it as ``output_format``.
+
+    Returns the original bytes when re-encoding would not make them smaller.
+    """
+    with Image.open(BytesIO(image_bytes)) as image:
+        resized = max(image.size) > max_dimension
+        image.thumbnail((max_dimension, max_dimension))
+
+        output_format = output_format.upper()
+        if output_format == "JPEG" and image.mode != "RGB":
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            else:
+                image = image.convert("RGB")
+
+        save_options = {"quality": quality, "optimize": True}
+        if output_format == "JPEG":
+            save_options["progressive"] = True
+        elif output_format == "WEBP":
+            save_options = {"quality": quality, "method": 4}
+
+        output = BytesIO()
+        image.save(output, format=output_format, **save_options)
+
+    processed_bytes = output.getvalue()
+    if not resized and len(processed_bytes) >= len(image_bytes):
+        return image_bytes
+    return processed_bytes
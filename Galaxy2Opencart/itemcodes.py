@@ -0,0 +1,150 @@
+import logging
+import threading
+from django.conf import settings
+from django.db import transaction
+from . import client
+from .models import ErpItemCode
+
+logger = logging.getLogger(__name__)
+
+ERP_ITEM_FETCH_PATH = "/api/glx/entities/item/fetch"
+
+# In-memory view of the ErpItemCode table, shared by all sync modules in the process
+_by_id = {}
+_by_sku = {}
+# Keys the ERP did not know about, so repeated lookups in a run stay local
+_unknown_ids = set()
+_unknown_skus = set()
+_loaded = False
+_lock = threading.RLock()
+
+
+def _chunks(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def load_item_codes():
+    global _loaded
+    with _lock:
+        if not _loaded:
+            for erp_id, sku in ErpItemCode.objects.values_list('erp_id', 'sku'):
+                _by_id[erp_id] = sku
+                _by_sku[sku] = erp_id
+            _loaded = True
+
+
+def fetch_item_codes_from_erp(erp_server_ip, erp_server_port, filters):
+    headers = {
+        "Content-Type": "application/json"
+    }
+    data = {
+        "SelectProperties": ["ID", "LightCrmCode"],
+        "Filters": filters
+    }
+    response = client.erp_post(erp_server_ip, erp_server_port, ERP_ITEM_FETCH_PATH, headers=headers, json=data)
+    if response.status_code != 200:
+        logger.error(f"Error fetching item codes from ERP: {response.text}")
+        return None
+    return [(str(item["ID"]), item["LightCrmCode"]) for item in response.json() or [] if item.get("ID") and item.get("LightCrmCode")]
+
+
+def fetch_item_codes_batch(erp_server_ip, erp_server_port, property_name, values):
+    """Fetches ID/LightCrmCode pairs for many items, one request per batch.
+
+    Uses an ``In`` filter and falls back to a full projection scan of all items
+    when the ERP rejects it. Raises RuntimeError when the scan fails as well, so
+    a failed lookup is never taken for items the ERP does not know.
+    """
+    batch_size = getattr(settings, 'ERP_ITEM_CODE_BATCH_SIZE', 500)
+    pairs = []
+    for batch in _chunks(values, batch_size):
+        filters = [
+            {
+                "Name": property_name,
+                "Type": "Default",
+                "Operator": "In",
+                "Value": batch
+            }
+        ]
+        batch_pairs = fetch_item_codes_from_erp(erp_server_ip, erp_server_port, filters)
+        if batch_pairs is None:
+            logger.info("Falling back to a full item code scan.")
+            all_pairs = fetch_item_codes_from_erp(erp_server_ip, erp_server_port, [])
+            if all_pairs is None:
+                raise RuntimeError("Could not fetch item codes from ERP.")
+            return all_pairs
+        pairs.extend(batch_pairs)
+    return pairs
+
+
+def store_item_codes(pairs):
+    if not pairs:
+        return
+    with _lock:
+        for erp_id, sku in pairs:
+            _by_id[erp_id] = sku
+            _by_sku[sku] = erp_id
+    with transaction.atomic():
+        for batch in _chunks(pairs, 500):
+            ErpItemCode.objects.filter(erp_id__in=[erp_id for erp_id, _ in batch]).delete()
+            ErpItemCode.objects.bulk_create([ErpItemCode(erp_id=erp_id, sku=sku) for erp_id, sku in batch])
+
+
+def resolve_skus(erp_server_ip, erp_server_port, item_ids):
+    """Returns ``{item_id: sku}``, asking the ERP only for ids not cached yet."""
+    load_item_codes()
+    item_ids = {str(item_id) for item_id in item_ids}
+    with _lock:
+        missing = [item_id for item_id in item_ids if item_id not in _by_id and item_id not in _unknown_ids]
+    if missing:
+        store_item_codes(fetch_item_codes_batch(erp_server_ip, erp_server_port, "ID", missing))
+    with _lock:
+        _unknown_ids.update(item_id for item_id in missing if item_id not in _by_id)
+        return {item_id: _by_id[item_id] for item_id in item_ids if item_id in _by_id}
+
+
+def resolve_ids(erp_server_ip, erp_server_port, skus):
+    """Returns ``{sku: item_id}``, asking the ERP only for SKUs not cached yet."""
+    load_item_codes()
+    skus = set(skus)
+    with _lock:
+        missing = [sku for sku in skus if sku not in _by_sku and sku not in _unknown_skus]
+    if missing:
+        store_item_codes(fetch_item_codes_batch(erp_server_ip, erp_server_port, "LightCrmCode", missing))
+    with _lock:
+        _unknown_skus.update(sku for sku in missing if sku not in _by_sku)
+        return {sku: _by_sku[sku] for sku in skus if sku in _by_sku}
+
+
+def forget_unknown_item_codes():
+    """Clears the negative cache, so items added to the ERP since are looked up again."""
+    with _lock:
+        _unknown_ids.clear()
+        _unknown_skus.clear()
+
+
+def invalidate_item_codes(item_ids=(), skus=()):
+    """Forgets cached codes of items that got a new ERP revision."""
+    load_item_codes()
+    item_ids = {str(item_id) for item_id in item_ids}
+    skus = set(skus)
+    with _lock:
+        _unknown_ids.difference_update(item_ids)
+        _unknown_skus.difference_update(skus)
+        for item_id in list(item_ids):
+            sku = _by_id.pop(item_id, None)
+            if sku is not None:
+                _by_sku.pop(sku, None)
+                skus.add(sku)
+        for sku in list(skus):
+            item_id = _by_sku.pop(sku, None)
+            if item_id is not None:
+                _by_id.pop(item_id, None)
+                item_ids.add(item_id)
+    with transaction.atomic():
+        for batch in _chunks(item_ids, 500):
+            ErpItemCode.objects.filter(erp_id__in=batch).delete()
+        for batch in _chunks(skus, 500):
+            ErpItemCode.objects.filter(sku__in=batch).delete()
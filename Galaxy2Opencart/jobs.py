@@ -0,0 +1,173 @@
+import importlib
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+from django.utils import timezone
+from . import locks
+from .models import SyncJob
+
+logger = logging.getLogger(__name__)
+
+# Job kind -> module whose run_import(progress=...) performs the sync
+SYNC_MODULES = {
+    'products': 'Galaxy2Opencart.products',
+    'orders': 'Galaxy2Opencart.orders',
+    'categories': 'Galaxy2Opencart.categories',
+    'images': 'Galaxy2Opencart.image',
+    'balance': 'Galaxy2Opencart.balance',
+}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobProgress:
+    """Progress callback handed to a sync's run_import.
+
+    Calling it with ``(done, total, errors)`` records progress, throughput in
+    items/sec and the estimated seconds left on the job row at most every
+    ``interval`` seconds, and raises JobCancelled once a cancellation has been
+    requested. It may be called from several threads.
+    """
+
+    def __init__(self, job, interval=1.0):
+        self.job = job
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_write = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self, done, total=None, errors=0):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_write < self.interval and (total is None or done < total):
+                return
+            self.last_write = now
+            progress = min(100, int(done * 100 / total)) if total else None
+            elapsed = now - self.started
+            rate = done / elapsed if elapsed > 0 else None
+            eta_seconds = int((total - done) / rate) if total and rate else None
+            SyncJob.objects.filter(pk=self.job.pk).update(
+                processed=done, total=total, progress=progress, rate=round(rate, 2) if rate is not None else None,
+                eta_seconds=eta_seconds, errors=errors)
+            if SyncJob.objects.filter(pk=self.job.pk, cancel_requested=True).exists():
+                raise JobCancelled()
+
+
+def enqueue(kind):
+    if kind not in SYNC_MODULES:
+        raise ValueError(f"Unknown sync job kind: {kind}")
+    job = SyncJob.objects.create(kind=kind)
+    logger.info(f"Queued {kind} sync as job {job.pk}.")
+    return job
+
+
+def request_cancel(job_id):
+    """Cancels a queued job right away, or asks a running one to stop at its next progress report."""
+    SyncJob.objects.filter(pk=job_id, status=SyncJob.QUEUED).update(status=SyncJob.CANCELLED, finished_at=timezone.now())
+    return SyncJob.objects.filter(pk=job_id, status=SyncJob.RUNNING).update(cancel_requested=True) > 0
+
+
+def claim_next_job(worker_name):
+    """Atomically moves the oldest queued job to running for this worker."""
+    while True:
+        job = SyncJob.objects.filter(status=SyncJob.QUEUED).order_by('id').first()
+        if job is None:
+            return None
+        # The conditional update only succeeds for one of several competing workers
+        claimed = SyncJob.objects.filter(pk=job.pk, status=SyncJob.QUEUED).update(
+            status=SyncJob.RUNNING, worker=worker_name, started_at=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def finish_job(job, status, message=''):
+    fields = {'status': status, 'message': message, 'finished_at': timezone.now()}
+    if status == SyncJob.SUCCEEDED:
+        fields['progress'] = 100
+    if status != SyncJob.RUNNING:
+        fields['eta_seconds'] = None
+    SyncJob.objects.filter(pk=job.pk).update(**fields)
+
+
+def job_lock_owner(job):
+    return f"job {job.pk} on {job.worker or default_worker_name()}"
+
+
+def reap_stale_jobs(kind, grace=60):
+    """Fails running jobs of ``kind`` that no longer hold the sync lock.
+
+    A worker that was killed leaves its job row running, but its lock expires,
+    so a running job without the lock (and past the short gap between claiming
+    the job and taking the lock) is dead.
+    """
+    holder = locks.lock_holder(kind)
+    stale = SyncJob.objects.filter(kind=kind, status=SyncJob.RUNNING, started_at__lt=timezone.now() - timedelta(seconds=grace))
+    for job in stale:
+        if holder != job_lock_owner(job):
+            finish_job(job, SyncJob.FAILED, "The worker running this job stopped.")
+            logger.error(f"Job {job.pk} ({job.kind} sync) marked failed, its worker stopped.")
+
+
+def has_pending_job(kind):
+    reap_stale_jobs(kind)
+    return SyncJob.objects.filter(kind=kind, status__in=[SyncJob.QUEUED, SyncJob.RUNNING]).exists()
+
+
+def run_job(job):
+    module = importlib.import_module(SYNC_MODULES[job.kind])
+    owner = job_lock_owner(job)
+    # One run per sync kind at a time, so two product runs never race on the revision watermark
+    with locks.held_lock(job.kind, owner) as acquired:
+        if not acquired:
+            finish_job(job, SyncJob.CANCELLED, f"Skipped, a {job.kind} sync is already running ({locks.lock_holder(job.kind)}).")
+            logger.info(f"Job {job.pk} skipped, a {job.kind} sync is already running.")
+            return
+        execute_job(job, module)
+
+
+def execute_job(job, module):
+    logger.info(f"Job {job.pk} started {job.kind} sync.")
+    try:
+        module.run_import(progress=JobProgress(job))
+    except JobCancelled:
+        finish_job(job, SyncJob.CANCELLED, "Cancelled by user.")
+        logger.info(f"Job {job.pk} cancelled.")
+    except Exception as e:
+        finish_job(job, SyncJob.FAILED, str(e))
+        logger.error(f"Job {job.pk} ({job.kind} sync) failed: {e}")
+    except BaseException:
+        # The worker is being stopped (Ctrl-C, SIGTERM), do not leave the job running
+        finish_job(job, SyncJob.FAILED, "Interrupted, the worker was stopped.")
+        raise
+    else:
+        finish_job(job, SyncJob.SUCCEEDED)
+        logger.info(f"Job {job.pk} finished {job.kind} sync.")
+
+
+def default_worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def job_to_dict(job):
+    return {
+        'id': job.pk,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'processed': job.processed,
+        'total': job.total,
+        'rate': job.rate,
+        'eta_seconds': job.eta_seconds,
+        'errors': job.errors,
+        'message': job.message,
+        'cancel_requested': job.cancel_requested,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
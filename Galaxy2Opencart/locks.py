@@ -0,0 +1,74 @@
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from .models import SyncLock
+
+logger = logging.getLogger(__name__)
+
+
+def default_ttl():
+    return getattr(settings, 'SYNC_LOCK_TTL', 600)
+
+
+def acquire_lock(name, owner, ttl=None):
+    """Takes the named lock for ``owner``; a lock whose holder stopped refreshing it expires after ``ttl`` seconds."""
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=ttl or default_ttl())
+    try:
+        with transaction.atomic():
+            SyncLock.objects.create(name=name, owner=owner, acquired_at=now, expires_at=expires_at)
+        return True
+    except IntegrityError:
+        pass
+    # Take over an expired lock, or re-enter one we already hold
+    taken = SyncLock.objects.filter(name=name, expires_at__lt=now).update(owner=owner, acquired_at=now, expires_at=expires_at)
+    if taken:
+        logger.info(f"Took over expired lock '{name}'.")
+        return True
+    return SyncLock.objects.filter(name=name, owner=owner).update(expires_at=expires_at) > 0
+
+
+def refresh_lock(name, owner, ttl=None):
+    expires_at = timezone.now() + timedelta(seconds=ttl or default_ttl())
+    return SyncLock.objects.filter(name=name, owner=owner).update(expires_at=expires_at) > 0
+
+
+def release_lock(name, owner):
+    SyncLock.objects.filter(name=name, owner=owner).delete()
+
+
+def lock_holder(name):
+    lock = SyncLock.objects.filter(name=name, expires_at__gte=timezone.now()).first()
+    return lock.owner if lock else None
+
+
+def _heartbeat(name, owner, ttl, stop):
+    try:
+        while not stop.wait(ttl / 3):
+            refresh_lock(name, owner, ttl)
+    finally:
+        connection.close()
+
+
+@contextmanager
+def held_lock(name, owner, ttl=None):
+    """Yields True while holding the lock, or False without waiting if someone else holds it.
+
+    The lock is refreshed in the background while held, so it only expires if
+    the holding process dies.
+    """
+    ttl = ttl or default_ttl()
+    acquired = acquire_lock(name, owner, ttl)
+    stop = threading.Event()
+    if acquired:
+        threading.Thread(target=_heartbeat, args=(name, owner, ttl, stop), name=f"lock-{name}", daemon=True).start()
+    try:
+        yield acquired
+    finally:
+        stop.set()
+        if acquired:
+            release_lock(name, owner)
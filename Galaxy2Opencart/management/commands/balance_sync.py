@@ -0,0 +1,67 @@
+import logging
+import random
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from Galaxy2Opencart import balance, jobs, locks
+
+logger = logging.getLogger('Galaxy2Opencart.balance')
+
+
+class Command(BaseCommand):
+    help = "Continuously polls ERP item balances and pushes changed quantities to OpenCart."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=getattr(settings, 'BALANCE_SYNC_INTERVAL', 30),
+                            help="Seconds between the start of two polls.")
+        parser.add_argument('--jitter', type=float, default=getattr(settings, 'BALANCE_SYNC_JITTER', 5),
+                            help="Random extra delay of up to this many seconds per poll.")
+        parser.add_argument('--once', action='store_true', help="Run a single poll and exit.")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        jitter = options['jitter']
+        owner = f"balance_sync on {jobs.default_worker_name()}"
+        previous_poll_at = None
+        metrics = {"polls": 0, "pushed": 0, "failed": 0, "max_lag": 0.0}
+
+        self.stdout.write(f"Balance sync running every {interval}s (+ up to {jitter}s jitter).")
+        try:
+            while True:
+                poll_at = time.time()
+                close_old_connections()
+                try:
+                    with locks.held_lock('balance', owner) as acquired:
+                        stats = balance.sync_balances() if acquired else None
+                    if not acquired:
+                        self.stdout.write("Skipping poll, another balance sync is running.")
+                except Exception as e:
+                    logger.error(f"Balance sync poll failed: {e}")
+                    stats = None
+                pushed_at = time.time()
+
+                if stats:
+                    metrics["polls"] += 1
+                    metrics["pushed"] += stats["pushed"]
+                    metrics["failed"] += stats["failed"]
+                    if stats["pushed"]:
+                        # A change pushed now happened in the ERP after the previous poll read it
+                        max_lag = pushed_at - (previous_poll_at or poll_at)
+                        min_lag = pushed_at - poll_at
+                        metrics["max_lag"] = max(metrics["max_lag"], max_lag)
+                        logger.info(f"Pushed {stats['pushed']} balance changes, ERP to OpenCart lag between {min_lag:.1f}s and {max_lag:.1f}s.")
+                    self.stdout.write(
+                        f"poll {metrics['polls']}: {stats['changed']} changed, {stats['pushed']} pushed, {stats['failed']} failed "
+                        f"in {pushed_at - poll_at:.1f}s (max lag so far {metrics['max_lag']:.1f}s)"
+                    )
+                previous_poll_at = poll_at
+
+                if options['once']:
+                    break
+                delay = interval + random.uniform(0, jitter) - (time.time() - poll_at)
+                if delay > 0:
+                    time.sleep(delay)
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(f"Balance sync stopped after {metrics['polls']} polls, {metrics['pushed']} quantities pushed.")
@@ -0,0 +1,31 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from Galaxy2Opencart import jobs, locks, scheduler
+
+
+class Command(BaseCommand):
+    help = "Queues sync jobs on the cadence configured in SYNC_SCHEDULE. Run together with run_sync_jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tick', type=float, default=getattr(settings, 'SCHEDULER_TICK', 30),
+                            help="Seconds between two checks for due schedules.")
+
+    def handle(self, *args, **options):
+        owner = f"scheduler on {jobs.default_worker_name()}"
+        with locks.held_lock('scheduler', owner) as acquired:
+            if not acquired:
+                self.stderr.write(f"Another scheduler is already running ({locks.lock_holder('scheduler')}).")
+                return
+            scheduler.load_schedules()
+            self.stdout.write("Scheduler started.")
+            try:
+                while True:
+                    close_old_connections()
+                    for job in scheduler.run_due_schedules():
+                        self.stdout.write(f"Queued {job.kind} sync as job {job.pk}.")
+                    time.sleep(options['tick'])
+            except KeyboardInterrupt:
+                pass
+        self.stdout.write("Scheduler stopped.")
@@ -0,0 +1,39 @@
+import logging
+import signal
+import sys
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from Galaxy2Opencart import jobs
+
+logger = logging.getLogger('Galaxy2Opencart.jobs')
+
+
+class Command(BaseCommand):
+    help = "Runs queued sync jobs. Start several of these processes to run jobs in parallel."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=getattr(settings, 'SYNC_JOB_POLL_INTERVAL', 2),
+                            help="Seconds to wait before checking for new jobs when the queue is empty.")
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty.")
+
+    def handle(self, *args, **options):
+        worker_name = jobs.default_worker_name()
+        # Stop on SIGTERM like on Ctrl-C, so the running job is marked as interrupted
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.stdout.write(f"Sync job worker {worker_name} started.")
+        try:
+            while True:
+                close_old_connections()
+                job = jobs.claim_next_job(worker_name)
+                if job is None:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                self.stdout.write(f"Running job {job.pk} ({job.kind}).")
+                jobs.run_job(job)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        self.stdout.write(f"Sync job worker {worker_name} stopped.")
@@ -15,8 +15,95 @@ class UserAnswer(models.Model):
     ftp_folder = models.CharField(max_length=255)
 
 class CategoryMapping(models.Model):
-    erp_id = models.CharField(max_length=255, null=True)
+    erp_id = models.CharField(max_length=255, null=True, unique=True)
     opencart_id = models.IntegerField(null=True)
+    # Snapshot of the ERP node as last pushed, used to find renamed and moved categories
+    parent_erp_id = models.CharField(max_length=255, null=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+
+class ProductMapping(models.Model):
+    sku = models.CharField(max_length=255, unique=True)
+    opencart_id = models.IntegerField(null=True)
+    payload_hash = models.CharField(max_length=64, blank=True, default='')
+
+class ErpItemCode(models.Model):
+    erp_id = models.CharField(max_length=255, unique=True)
+    sku = models.CharField(max_length=255, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+class ImageLedger(models.Model):
+    erp_image_id = models.CharField(max_length=255, unique=True)
+    content_hash = models.CharField(max_length=64)
+    opencart_product_id = models.IntegerField(null=True)
+    revision_number = models.CharField(max_length=255, blank=True, default='')
+    uploaded_at = models.DateTimeField(auto_now=True)
+
+class BalanceSnapshot(models.Model):
+    sku = models.CharField(max_length=255, unique=True)
+    # The quantity exactly as it was sent to OpenCart
+    quantity = models.CharField(max_length=64)
+
+class OrderExport(models.Model):
+    EXPORTED = 'exported'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (EXPORTED, 'Exported'),
+        (FAILED, 'Failed'),
+    ]
+
+    order_id = models.CharField(max_length=255, unique=True)
+    erp_docid = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=FAILED)
+    attempts = models.IntegerField(default=0)
+    payload_hash = models.CharField(max_length=64, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+class SyncCheckpoint(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    revision_number = models.CharField(max_length=255)
+    updated_at = models.DateTimeField(auto_now=True)
+
+class SyncJob(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+
+    kind = models.CharField(max_length=32)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    progress = models.IntegerField(null=True)
+    processed = models.IntegerField(default=0)
+    total = models.IntegerField(null=True)
+    rate = models.FloatField(null=True)
+    eta_seconds = models.IntegerField(null=True)
+    errors = models.IntegerField(default=0)
+    message = models.TextField(blank=True)
+    cancel_requested = models.BooleanField(default=False)
+    worker = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+class SyncLock(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+    owner = models.CharField(max_length=255)
+    acquired_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
+
+class SyncSchedule(models.Model):
+    kind = models.CharField(max_length=32, unique=True)
+    interval_minutes = models.IntegerField()
+    enabled = models.BooleanField(default=True)
+    last_run_at = models.DateTimeField(null=True)
+    next_run_at = models.DateTimeField(null=True)
 
 class ConsoleMessage(models.Model):
     message = models.TextField()
@@ -1,73 +1,61 @@
-import requests
+import hashlib
 import json
 import logging
-from .models import UserAnswer
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import transaction
+from . import checkpoints, client, itemcodes
+from .models import OrderExport, UserAnswer
 
 logger = logging.getLogger(__name__)
 
-def authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port):
-    erp_auth_path = "/auth"
-    erp_auth_url = f"http://{erp_server_ip}:{erp_server_port}{erp_auth_path}"
-    erp_auth_data = {
-        "username": erp_username,
-        "password": erp_password
-    }
-    response = requests.get(erp_auth_url, params=erp_auth_data)
-    session_cookie = response.cookies.get("ss-id")
-    return session_cookie
+ORDER_CHECKPOINT = 'orders'
 
-def retrieve_order_data_from_opencart(opencart_api_url, opencart_api_key, status_id=1):
+def retrieve_order_data_from_opencart(opencart_api_url, opencart_api_key, status_id=1, date_added_from=None):
     orders_url = f"{opencart_api_url}/listorderswithdetails&filter_order_status_id={status_id}"
+    if date_added_from:
+        # OpenCart compares whole days, orders of the watermark day are listed again and skipped via the ledger
+        orders_url += f"&filter_date_added_from={date_added_from[:10]}"
     headers = {"X-Oc-Restadmin-Id": opencart_api_key}
-    response = requests.get(orders_url, headers=headers)
+    response = client.get(orders_url, headers=headers)
     if response.status_code == 200:
         return response.json()["data"]
     else:
         logger.error("Failed to retrieve orders from OpenCart")
         return []
 
-def post_order_data_to_erp(session_cookie, erp_endpoint, order_data):
+def post_order_data_to_erp(erp_server_ip, erp_server_port, order_data):
+    """Posts one order entry to the ERP. Returns True on success."""
+    erp_postentry_path = "/services/sync/actions/postentry"
     headers = {
-        "Cookie": f"ss-id={session_cookie}",
         "Content-Type": "application/json"
     }
-    json_order_data = json.dumps(order_data, ensure_ascii=False)
-    response = requests.post(erp_endpoint, headers=headers, json=json.loads(json_order_data))
-    response_json = response.json()
-    json_order_data = json.loads(json_order_data)
-    doc_id = json_order_data["body"]["data"]["docid"]
+    doc_id = order_data["body"]["data"]["docid"]
+    try:
+        response = client.erp_post(erp_server_ip, erp_server_port, erp_postentry_path, headers=headers, json=order_data)
+    except Exception as e:
+        logger.error(f"Error posting order {doc_id} to ERP: {e}")
+        return False
     if response.status_code == 200:
         logger.info(f"Order {doc_id} posted to ERP successfully.")
-    else:
-        error_message = response_json["ResponseStatus"]["Message"]
-        logger.error(f"Error posting order {doc_id} to ERP: {error_message}")
+        return True
+    try:
+        error_message = response.json()["ResponseStatus"]["Message"]
+    except (ValueError, KeyError, TypeError):
+        error_message = response.text
+    logger.error(f"Error posting order {doc_id} to ERP: {error_message}")
+    return False
 
-def get_id_from_erp(session_cookie, erp_server_ip, erp_server_port, sku):
-    erp_item_url = f"http://{erp_server_ip}:{erp_server_port}/api/glx/entities/item/fetch"
-    headers = {
-        "Cookie": f"ss-id={session_cookie}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "SelectProperties": ["ID", "LightCrmCode"],
-        "Filters": [
-            {
-                "Name": "LightCrmCode",
-                "Type": "Default",
-                "Operator": "Equal",
-                "Value": sku
-            }
-        ]
-    }
-    response = requests.post(erp_item_url, headers=headers, json=data)
-    item_data = response.json()
-    if item_data:
-        product_id = item_data[0].get("ID")
-        return product_id
-    else:
-        return None
+def get_id_from_erp(erp_server_ip, erp_server_port, sku):
+    return itemcodes.resolve_ids(erp_server_ip, erp_server_port, [sku]).get(sku)
 
-def construct_erp_order_data(opencart_order, session_cookie, erp_server_ip, erp_server_port):
+def construct_erp_order_data(opencart_order, erp_server_ip, erp_server_port, item_ids=None):
+    """Builds the ERP postentry payload for an OpenCart order.
+
+    ``item_ids`` maps SKUs to ERP item ids resolved beforehand; without it each
+    line is looked up on its own.
+    """
     print("Constructing ERP order data for OpenCart order ID:", opencart_order["order_id"])  # Debugging
     print("Products in order:", opencart_order["products"])  # Debugging
     erp_order_data = {
@@ -154,7 +142,10 @@ def construct_erp_order_data(opencart_order, session_cookie, erp_server_ip, erp_
     # Construct line items and add them directly to the 'lines' list in erp_order_data
     for product in opencart_order["products"]:       
         print("Processing product:", product["sku"])  # Debugging
-        product_id = get_id_from_erp(session_cookie, erp_server_ip, erp_server_port, product["sku"])
+        if item_ids is not None:
+            product_id = item_ids.get(product["sku"])
+        else:
+            product_id = get_id_from_erp(erp_server_ip, erp_server_port, product["sku"])
         print("Product ID from ERP:", product_id)  # Debugging
         if product_id:
             erp_line_item = {
@@ -179,11 +170,129 @@ def construct_erp_order_data(opencart_order, session_cookie, erp_server_ip, erp_
     return erp_order_data
 
 
+def hash_order_entry(erp_order_data):
+    payload = json.dumps(erp_order_data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def order_sort_key(opencart_order):
+    return (opencart_order["date_added"], int(opencart_order["order_id"]))
+
+
+def read_order_ledger(order_ids):
+    return OrderExport.objects.in_bulk([str(order_id) for order_id in order_ids], field_name='order_id')
+
+
+def is_order_settled(entry):
+    """An order is done once it was exported, or once it failed ORDER_EXPORT_MAX_ATTEMPTS times."""
+    if entry is None:
+        return False
+    return entry.status == OrderExport.EXPORTED or entry.attempts >= getattr(settings, 'ORDER_EXPORT_MAX_ATTEMPTS', 5)
+
+
+def record_order_exports(results, ledger):
+    """Stores ``(order_id, erp_order_data, success)`` results in the ledger and updates ``ledger`` in place.
+
+    ``erp_order_data`` is None for an order whose entry could not be built.
+    """
+    to_update = []
+    to_create = []
+    for order_id, erp_order_data, success in results:
+        entry = ledger.get(order_id)
+        if entry is None:
+            entry = OrderExport(order_id=order_id)
+            ledger[order_id] = entry
+            to_create.append(entry)
+        else:
+            to_update.append(entry)
+        if erp_order_data is not None:
+            entry.erp_docid = str(erp_order_data["body"]["data"]["docid"])
+            entry.payload_hash = hash_order_entry(erp_order_data)
+        entry.status = OrderExport.EXPORTED if success else OrderExport.FAILED
+        entry.attempts += 1
+        if not success and is_order_settled(entry):
+            logger.error(f"Giving up on order {order_id} after {entry.attempts} failed export attempts.")
+    with transaction.atomic():
+        OrderExport.objects.bulk_update(to_update, ['erp_docid', 'status', 'attempts', 'payload_hash', 'updated_at'], batch_size=500)
+        OrderExport.objects.bulk_create(to_create, batch_size=500)
+
+
+def next_order_watermark(opencart_orders, ledger, watermark):
+    """Advances the date_added watermark up to the first order that still has to be exported."""
+    for order in sorted(opencart_orders, key=order_sort_key):
+        if not is_order_settled(ledger.get(str(order["order_id"]))):
+            break
+        watermark = max(watermark or '', order["date_added"])
+    return watermark
+
+
+def export_orders_to_erp(erp_server_ip, erp_server_port, opencart_orders, progress=None):
+    """Posts orders to the ERP with ORDER_EXPORT_WORKERS entries in flight at once.
+
+    Orders already in the export ledger are skipped, so an order is never posted
+    twice. The rest are handled in batches of ORDER_EXPORT_BATCH_SIZE, and the
+    SKUs of a whole batch are resolved in one ERP lookup before its entries are
+    built. Returns counts of exported, skipped and failed orders and the
+    throughput.
+    """
+    workers = getattr(settings, 'ORDER_EXPORT_WORKERS', 4)
+    batch_size = getattr(settings, 'ORDER_EXPORT_BATCH_SIZE', 100)
+    stats = {"exported": 0, "skipped": 0, "failed": 0, "orders_per_second": 0.0}
+    started = time.monotonic()
+
+    ledger = read_order_ledger(order["order_id"] for order in opencart_orders)
+    pending_orders = [order for order in sorted(opencart_orders, key=order_sort_key) if not is_order_settled(ledger.get(str(order["order_id"])))]
+    stats["skipped"] = len(opencart_orders) - len(pending_orders)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for batch_start in range(0, len(pending_orders), batch_size):
+            batch = pending_orders[batch_start:batch_start + batch_size]
+            # Raises when the ERP lookup fails, so no entry is posted without its lines
+            item_ids = itemcodes.resolve_ids(erp_server_ip, erp_server_port, {product["sku"] for order in batch for product in order["products"]})
+            # Every entry is built before any is posted, so a broken order cannot stop the batch halfway
+            entries = []
+            failed_builds = []
+            for order in batch:
+                order_id = str(order["order_id"])
+                try:
+                    entries.append((order_id, construct_erp_order_data(order, erp_server_ip, erp_server_port, item_ids)))
+                except Exception as e:
+                    # Counted as a failed attempt, so the order is given up on after ORDER_EXPORT_MAX_ATTEMPTS runs
+                    logger.error(f"Could not build the ERP entry of order {order_id}: {e}")
+                    failed_builds.append((order_id, None, False))
+            stats["failed"] += len(failed_builds)
+            posts = []
+            results = []
+            try:
+                for order_id, entry in entries:
+                    posts.append((order_id, entry, executor.submit(post_order_data_to_erp, erp_server_ip, erp_server_port, entry)))
+                for order_id, entry, future in posts:
+                    success = future.result()
+                    results.append((order_id, entry, success))
+                    stats["exported" if success else "failed"] += 1
+                    if progress:
+                        progress(stats["exported"] + stats["failed"], len(pending_orders), stats["failed"])
+            finally:
+                # Also on cancellation or errors: every entry that reached the ERP must be in the ledger
+                unfinished = [post for post in posts[len(results):] if not post[2].cancel()]
+                for order_id, entry, future in unfinished:
+                    results.append((order_id, entry, future.result()))
+                record_order_exports(failed_builds + results, ledger)
+
+    elapsed = time.monotonic() - started
+    if pending_orders and elapsed > 0:
+        stats["orders_per_second"] = round(len(pending_orders) / elapsed, 2)
+    logger.info(f"Exported {stats['exported']} of {len(pending_orders)} new orders to ERP in {elapsed:.1f}s "
+                f"({stats['orders_per_second']} orders/sec, {stats['failed']} failed, {stats['skipped']} already exported).")
+    stats["watermark"] = next_order_watermark(opencart_orders, ledger, None)
+    return stats
+
+
 def get_user_answers_from_db():
     answers = UserAnswer.objects.latest('id')
     return answers
 
-def run_import():
+def run_import(progress=None):
     user_answers = get_user_answers_from_db()
 
     store_domain = user_answers.store_domain
@@ -195,13 +304,16 @@ def run_import():
     opencart_api_key = user_answers.opencart_api_key
 
     opencart_api_url = f"http://{store_domain}{store_path}/index.php?route=rest/order_admin"
-    session_cookie = authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port)
+    session_cookie = client.authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port)
 
     if session_cookie:
-        opencart_orders = retrieve_order_data_from_opencart(opencart_api_url, opencart_api_key)
-        for order in opencart_orders:
-            erp_order_data = construct_erp_order_data(order, session_cookie, erp_server_ip, erp_server_port)
-            print("Final ERP order data:", json.dumps(erp_order_data, indent=4))  # Debugging
-            post_order_data_to_erp(session_cookie, f"http://{erp_server_ip}:{erp_server_port}/services/sync/actions/postentry", erp_order_data)
+        itemcodes.forget_unknown_item_codes()
+        watermark = checkpoints.read_checkpoint(ORDER_CHECKPOINT)
+        opencart_orders = retrieve_order_data_from_opencart(opencart_api_url, opencart_api_key, date_added_from=watermark)
+        stats = export_orders_to_erp(erp_server_ip, erp_server_port, opencart_orders, progress)
+        if stats["watermark"] and stats["watermark"] != watermark:
+            checkpoints.write_checkpoint(ORDER_CHECKPOINT, stats["watermark"])
+            logger.info(f"Order export watermark advanced to {stats['watermark']}.")
+        return stats
     else:
         logger.error("Authentication with ERP failed.")
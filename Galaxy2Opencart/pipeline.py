@@ -0,0 +1,151 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name, func, workers):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def count(self, key):
+        with self.lock:
+            setattr(self, key, getattr(self, key) + 1)
+
+    def stats(self):
+        elapsed = (self.finished_at or time.monotonic()) - (self.started_at or time.monotonic())
+        return {
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "seconds": round(elapsed, 2),
+            "per_second": round(self.processed / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+
+
+class Pipeline:
+    """Runs items through stages, each with its own worker threads.
+
+    Stages are connected by queues of ``queue_size`` items, so a slow stage
+    applies back-pressure to the ones before it and memory stays bounded. A
+    stage function returns the value handed to the next stage, or ``None`` to
+    drop the item; exceptions are logged and count as failures.
+
+    ``on_item_done`` is called with the number of items that left the pipeline
+    so far and how many of them failed in a stage. If it raises, the remaining items are drained without being
+    processed and ``run`` re-raises the exception.
+    """
+
+    def __init__(self, name, queue_size=16, log=None, on_item_done=None):
+        self.name = name
+        self.queue_size = queue_size
+        self.stages = []
+        self.logger = log or logger
+        self.on_item_done = on_item_done
+        self.completed = 0
+        self.failed = 0
+        self.completed_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.error = None
+
+    def add_stage(self, name, func, workers=1):
+        self.stages.append(Stage(name, func, workers))
+        return self
+
+    def _item_done(self, failed=False):
+        with self.completed_lock:
+            self.completed += 1
+            self.failed += failed
+            if self.on_item_done is None or self.stopped.is_set():
+                return
+            try:
+                self.on_item_done(self.completed, self.failed)
+            except Exception as e:
+                self.error = e
+                self.stopped.set()
+
+    def _work(self, stage, inbox, outbox, remaining):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            if self.stopped.is_set():
+                continue
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                self.logger.error(f"{self.name}: {stage.name} stage failed: {e}")
+                stage.count("failed")
+                self._item_done(failed=True)
+                continue
+            if result is None:
+                stage.count("dropped")
+                self._item_done()
+                continue
+            stage.count("processed")
+            if outbox is not None:
+                outbox.put(result)
+            else:
+                self._item_done()
+
+        with stage.lock:
+            remaining[stage.name] -= 1
+            last_worker = remaining[stage.name] == 0
+        if last_worker:
+            stage.finished_at = time.monotonic()
+            if outbox is not None:
+                next_stage = self.stages[self.stages.index(stage) + 1]
+                for _ in range(next_stage.workers):
+                    outbox.put(_DONE)
+
+    def run(self, items):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = {stage.name: stage.workers for stage in self.stages}
+        threads = []
+        for position, stage in enumerate(self.stages):
+            outbox = queues[position + 1] if position + 1 < len(self.stages) else None
+            stage.started_at = time.monotonic()
+            for number in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[position], outbox, remaining),
+                    name=f"{self.name}-{stage.name}-{number}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in items:
+                if self.stopped.is_set():
+                    break
+                queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        if self.error is not None:
+            raise self.error
+        return self.stats()
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def log_stats(self):
+        for name, stats in self.stats().items():
+            self.logger.info(f"{self.name} {name}: {stats['processed']} processed, {stats['dropped']} skipped, {stats['failed']} failed "
+                             f"in {stats['seconds']}s ({stats['per_second']}/s).")
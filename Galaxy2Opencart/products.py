@@ -1,47 +1,36 @@
-import requests
+import hashlib
+import itertools
+import json
 import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.conf import settings
+from django.db import transaction
 from django.http import JsonResponse
-from .models import CategoryMapping, UserAnswer
+from . import client, itemcodes
+from .checkpoints import CheckpointWriter, read_checkpoint, write_checkpoint
+from .models import CategoryMapping, ProductMapping, UserAnswer
 
 # Setting up logging
 logger = logging.getLogger(__name__)
 
 
-def authenticate_with_erp(erp_username, erp_password, erp_server_ip, erp_server_port):
-    erp_auth_path = "/auth"
-    erp_auth_url = f"http://{erp_server_ip}:{erp_server_port}{erp_auth_path}"
-    erp_auth_data = {
-        "username": erp_username,
-        "password": erp_password
-    }
-
-    try:
-        response = requests.get(erp_auth_url, params=erp_auth_data)
-        response.raise_for_status()
-        session_cookie = response.cookies.get("ss-id")
-        return session_cookie
-    except Exception as e:
-        logger.error(f"Error during ERP authentication: {e}")
-        return None
-
-def fetch_items_from_erp(session_cookie, erp_server_ip, erp_server_port, last_revision_number):
+def iter_items_from_erp(erp_server_ip, erp_server_port, last_revision_number):
+    """Yields changed ERP items one by one while the response is still downloading."""
     erp_items_path = "/services/sync/items"
-    erp_items_url = f"http://{erp_server_ip}:{erp_server_port}{erp_items_path}"
     params = {
         "RevisionNumber": last_revision_number
     }
-    headers = {
-        "Cookie": f"ss-id={session_cookie}"
-    }
+    chunk_size = getattr(settings, 'ERP_STREAM_CHUNK_SIZE', 65536)
 
     try:
-        response = requests.get(erp_items_url, headers=headers, params=params)
-        response.raise_for_status()
-        items = response.json()
-        return items
+        with client.erp_get(erp_server_ip, erp_server_port, erp_items_path, params=params, stream=True) as response:
+            response.raise_for_status()
+            yield from client.iter_json_array(response, chunk_size=chunk_size)
     except Exception as e:
         logger.error(f"Error fetching items from ERP: {e}")
-        return []
+
+def fetch_items_from_erp(erp_server_ip, erp_server_port, last_revision_number):
+    return list(iter_items_from_erp(erp_server_ip, erp_server_port, last_revision_number))
 
 def read_categories_mapping():
     mappings = CategoryMapping.objects.all()
@@ -49,10 +38,81 @@ def read_categories_mapping():
     return categories_mapping
 
 
+def read_product_mapping():
+    return dict(ProductMapping.objects.values_list('sku', 'opencart_id'))
+
+
+def read_product_hashes():
+    return dict(ProductMapping.objects.exclude(payload_hash='').values_list('sku', 'payload_hash'))
+
+
+def hash_transformed_item(transformed_item):
+    """Fingerprint of the OpenCart representation of an item, independent of key order."""
+    payload = json.dumps(transformed_item, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def fetch_opencart_products(opencart_api_url, opencart_api_key, page, limit):
+    list_url = f"{opencart_api_url}&limit={limit}&page={page}"
+    response = client.get(list_url, headers={"X-Oc-Restadmin-Id": opencart_api_key})
+    if response.status_code != 200:
+        logger.error(f"Error listing products from OpenCart (page {page}): {response.text}")
+        return None
+    response_data = response.json()
+    if response_data.get('success') != 1:
+        return []
+    return response_data.get('data') or []
+
+
+def build_product_mapping(opencart_api_url, opencart_api_key):
+    """Rebuilds the local SKU -> OpenCart product_id index from the paged product listing.
+
+    Returns None when the listing fails, so the caller never mistakes an
+    unreadable store for an empty one.
+    """
+    limit = getattr(settings, 'OPENCART_PRODUCTS_PAGE_SIZE', 100)
+    product_mapping = {}
+    previous_page_ids = None
+    page = 1
+    while True:
+        products = fetch_opencart_products(opencart_api_url, opencart_api_key, page, limit)
+        if products is None:
+            return None
+        page_ids = [product.get('product_id') or product.get('id') for product in products]
+        # Page until an empty page, the API may cap the page size below the requested limit.
+        # A repeated page means the API ignores paging, so there is nothing more to read.
+        if not products or page_ids == previous_page_ids:
+            break
+        previous_page_ids = page_ids
+        for product in products:
+            product_id = product.get('product_id') or product.get('id')
+            if product.get('sku') and product_id:
+                product_mapping[product['sku']] = int(product_id)
+        page += 1
+
+    with transaction.atomic():
+        ProductMapping.objects.all().delete()
+        ProductMapping.objects.bulk_create(
+            [ProductMapping(sku=sku, opencart_id=product_id) for sku, product_id in product_mapping.items()],
+            batch_size=500,
+        )
+    logger.info(f"Indexed {len(product_mapping)} OpenCart products by SKU.")
+    return product_mapping
+
+
+def save_product_mappings(mapping_changes):
+    """Applies buffered SKU index changes of ``(product_id, payload_hash)``; ``None`` removes the SKU."""
+    ProductMapping.objects.filter(sku__in=list(mapping_changes)).delete()
+    ProductMapping.objects.bulk_create(
+        [ProductMapping(sku=sku, opencart_id=change[0], payload_hash=change[1]) for sku, change in mapping_changes.items() if change],
+        batch_size=500,
+    )
+
+
 def transform_item_for_opencart(item, categories_mapping):
     erp_categories = item.get("ItemCategories", [])
     erp_child_category = erp_categories[-1] if erp_categories else None
-    opencart_category_id = categories_mapping.get(erp_child_category["CategoryLeafID"], 25) if erp_child_category else 25
+    opencart_category_id = categories_mapping.get(str(erp_child_category["CategoryLeafID"]), 25) if erp_child_category else 25
 
     transformed_item = {
         "model": item["Code"],
@@ -83,53 +143,217 @@ def instance_to_dict(instance):
     return {field.name: getattr(instance, field.name) for field in instance._meta.fields}
 
 
-def run_import():
+def find_product_id_by_sku(opencart_api_url, sku, opencart_api_key):
+    """Looks a single SKU up in OpenCart.
+
+    Returns ``(found, product_id)``; ``found`` is False when the lookup itself
+    failed, so the caller must not assume the product is missing.
+    """
+    check_url = f"{opencart_api_url.rsplit('/', 1)[0]}/getproductbysku&sku={sku}"
+    response = client.get(check_url, headers={"X-Oc-Restadmin-Id": opencart_api_key})
+    if response.status_code == 404:
+        return True, None
+    if response.status_code != 200:
+        logger.error(f"Error looking up SKU {sku} in OpenCart: {response.text}")
+        return False, None
+    response_data = response.json()
+    if response_data.get('success') == 1 and response_data.get('data'):
+        product_id = response_data['data'].get('id') or response_data['data'].get('product_id')
+        return True, int(product_id) if product_id else None
+    return True, None
+
+
+def push_item_to_opencart(transformed_item, product_id, opencart_api_url, opencart_api_key):
+    """Writes one product to OpenCart. Runs in a worker thread, so it only talks HTTP.
+
+    A SKU missing from the index is looked up by SKU once before it is created,
+    so a product the index does not know about yet is updated, not duplicated.
+    Returns a ``(success, product_id, stale_mapping)`` tuple where ``stale_mapping``
+    tells the caller that the indexed product id no longer exists in OpenCart.
+    """
+    name = transformed_item['product_description'][0]['name']
+    headers = {"X-Oc-Restadmin-Id": opencart_api_key}
+    stale_mapping = False
+
+    if not product_id:
+        found, product_id = find_product_id_by_sku(opencart_api_url, transformed_item['sku'], opencart_api_key)
+        if not found:
+            return False, None, stale_mapping
+
+    # Update the product in place when its id is known
+    if product_id:
+        update_url = f"{opencart_api_url}&id={product_id}"
+        update_response = client.put(update_url, headers=headers, json=transformed_item)
+        if update_response.status_code == 200:
+            logger.info(f"Item {name} updated successfully in OpenCart.")
+            return True, product_id, stale_mapping
+        if update_response.status_code != 404:
+            logger.error(f"Error updating item {name} in OpenCart: {update_response.text}")
+            return False, product_id, stale_mapping
+        # The product was deleted in OpenCart, forget it and create it again
+        stale_mapping = True
+
+    # If the product does not exist, post it to OpenCart
+    created_item_response = client.post(opencart_api_url, headers=headers, json=transformed_item)
+    if created_item_response.status_code == 200:
+        logger.info(f"Item {name} successfully posted to OpenCart.")
+        created_product_id = (created_item_response.json().get('data') or {}).get('id')
+        return True, int(created_product_id) if created_product_id else None, stale_mapping
+
+    logger.error(f"Error posting item {name} to OpenCart: {created_item_response.text}")
+    return False, None, stale_mapping
+
+
+def push_items_to_opencart(erp_items, categories_mapping, product_mapping, product_hashes, mapping_changes, opencart_api_url, opencart_api_key, on_confirmed, progress=None):
+    """Pushes items with a bounded worker pool and returns written/skipped/failed counts.
+
+    Items whose transformed payload matches the fingerprint of the last write are
+    skipped without a request. ``on_confirmed`` is called with each item whose
+    predecessors have all been written (or skipped) successfully, in ERP order, so
+    the revision watermark never skips over an item that failed or is still in
+    flight. Changes to the SKU index are recorded in ``mapping_changes`` for the
+    caller to persist, except ids of newly created products, which are saved right
+    away. ``progress`` is called with the number of handled items.
+    """
+    workers = max(1, getattr(settings, 'PRODUCT_PUSH_WORKERS', 1))
+    max_in_flight = workers * 2
+    pending = {}
+    results = {}
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+    submitted = 0
+    next_to_confirm = 0
+    blocked = False
+
+    def confirm():
+        nonlocal next_to_confirm, blocked
+        if progress:
+            progress(counts["written"] + counts["skipped"] + counts["failed"], errors=counts["failed"])
+        while not blocked and next_to_confirm in results:
+            item, success = results.pop(next_to_confirm)
+            if not success:
+                blocked = True
+                break
+            on_confirmed(item)
+            next_to_confirm += 1
+
+    def collect(done):
+        for future in done:
+            index, item, sku, payload_hash = pending.pop(future)
+            try:
+                success, product_id, stale_mapping = future.result()
+            except Exception as e:
+                logger.error(f"Error pushing item {sku} to OpenCart: {e}")
+                success, product_id, stale_mapping = False, None, False
+
+            if stale_mapping:
+                product_mapping.pop(sku, None)
+                product_hashes.pop(sku, None)
+                mapping_changes[sku] = None
+            if success and product_id:
+                created = product_mapping.get(sku) != product_id
+                product_mapping[sku] = product_id
+                product_hashes[sku] = payload_hash
+                mapping_changes[sku] = (product_id, payload_hash)
+                if created:
+                    # A new product id must survive a crash, or the product would be created twice
+                    save_product_mappings({sku: mapping_changes.pop(sku)})
+            counts["written" if success else "failed"] += 1
+            results[index] = (item, success)
+        confirm()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in erp_items:
+            transformed_item = transform_item_for_opencart(item, categories_mapping)
+            sku = transformed_item['sku']
+            payload_hash = hash_transformed_item(transformed_item)
+            if product_mapping.get(sku) and product_hashes.get(sku) == payload_hash:
+                counts["skipped"] += 1
+                results[submitted] = (item, True)
+                submitted += 1
+                confirm()
+                continue
+
+            future = executor.submit(push_item_to_opencart, transformed_item, product_mapping.get(sku), opencart_api_url, opencart_api_key)
+            pending[future] = (submitted, item, sku, payload_hash)
+            submitted += 1
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    if blocked:
+        logger.error(f"Revision watermark held at item {next_to_confirm + 1} of {submitted} because it was not written to OpenCart.")
+    return counts
+
+
+def run_import(progress=None):
     user_answer_instance = get_user_answers_from_db()
     user_answers = instance_to_dict(user_answer_instance)
 
     opencart_api_url = f"https://{user_answers['store_domain']}{user_answers['store_path']}/index.php?route=rest/product_admin/products"
     opencart_api_key = user_answers['opencart_api_key']
 
-    session_cookie = authenticate_with_erp(user_answers['erp_username'], user_answers['erp_password'], user_answers['erp_server_ip'], user_answers['erp_server_port'])
+    session_cookie = client.authenticate_with_erp(user_answers['erp_username'], user_answers['erp_password'], user_answers['erp_server_ip'], user_answers['erp_server_port'])
     categories_mapping = read_categories_mapping()
 
     if session_cookie:
-        erp_items = fetch_items_from_erp(session_cookie, user_answers['erp_server_ip'], user_answers['erp_server_port'], user_answers['last_revision_number'])
-
-        if erp_items:
-            for item in erp_items:
-                transformed_item = transform_item_for_opencart(item, categories_mapping)
-
-                # Check if product already exists in OpenCart
-                check_url = f"https://{user_answers['store_domain']}{user_answers['store_path']}/index.php?route=rest/product_admin/getproductbysku&sku={transformed_item['sku']}"
-                existing_product_response = requests.get(check_url, headers={"X-Oc-Restadmin-Id": opencart_api_key})
-                if existing_product_response.status_code == 200:
-                    response_data = existing_product_response.json()
-                    if response_data.get('success') == 1 and response_data.get('data'):
-                        product_id = response_data['data'].get('id')
-                        if product_id:
-                            # Update the existing product in OpenCart
-                            update_url = f"{opencart_api_url}&id={product_id}"
-                            update_response = requests.put(update_url, headers={"X-Oc-Restadmin-Id": opencart_api_key}, json=transformed_item)
-                            if update_response.status_code == 200:
-                                logger.info(f"Item {transformed_item['product_description'][0]['name']} updated successfully in OpenCart.")
-                            else:
-                                logger.error(f"Error updating item {transformed_item['product_description'][0]['name']} in OpenCart: {update_response.text}")
-                            continue
-
-                # If the product does not exist, post it to OpenCart
-                created_item_response = requests.post(opencart_api_url, headers={"X-Oc-Restadmin-Id": opencart_api_key}, json=transformed_item)
-                if created_item_response.status_code == 200:
-                    logger.info(f"Item {transformed_item['product_description'][0]['name']} successfully posted to OpenCart.")
-                else:
-                    logger.error(f"Error posting item {transformed_item['product_description'][0]['name']} to OpenCart: {created_item_response.text}")
-
-                user_answers['last_revision_number'] = item["RevisionNumber"]
-                user_answer_instance.last_revision_number = user_answers['last_revision_number']
-                user_answer_instance.save()
+        # The checkpoint table is authoritative and UserAnswer mirrors it for the settings form.
+        # A form value that differs from the mirror was set by the operator to force a resync.
+        last_revision_number = read_checkpoint('products')
+        if last_revision_number is None or str(user_answers['last_revision_number']) != last_revision_number:
+            if last_revision_number is not None:
+                logger.info(f"Revision number changed in the settings, syncing from {user_answers['last_revision_number']} instead of {last_revision_number}.")
+            last_revision_number = user_answers['last_revision_number']
+            write_checkpoint('products', last_revision_number)
+        erp_items = iter_items_from_erp(user_answers['erp_server_ip'], user_answers['erp_server_port'], last_revision_number)
+        first_item = next(erp_items, None)
+
+        if first_item is not None:
+            erp_items = itertools.chain([first_item], erp_items)
+            product_mapping = read_product_mapping()
+            if not product_mapping:
+                product_mapping = build_product_mapping(opencart_api_url, opencart_api_key)
+                if product_mapping is None:
+                    # Without the index every product would be created again
+                    logger.error("Could not build the OpenCart product index, aborting the product sync.")
+                    raise RuntimeError("Could not build the OpenCart product index.")
+            product_hashes = read_product_hashes()
+
+            mapping_changes = {}
+
+            def save_mapping_changes():
+                if mapping_changes:
+                    save_product_mappings(mapping_changes)
+                    mapping_changes.clear()
+                # Keep the mirror in step with every checkpoint write, so it never looks like an operator change
+                if checkpoint.revision_number is not None:
+                    UserAnswer.objects.filter(pk=user_answer_instance.pk).update(last_revision_number=checkpoint.revision_number)
+
+            changed_items = {"ids": set(), "codes": set()}
+
+            def confirm_item(item):
+                if item.get("ID"):
+                    changed_items["ids"].add(item["ID"])
+                changed_items["codes"].add(item["Code"])
+                checkpoint.advance(item["RevisionNumber"])
+
+            with CheckpointWriter('products', before_flush=save_mapping_changes) as checkpoint:
+                counts = push_items_to_opencart(erp_items, categories_mapping, product_mapping, product_hashes, mapping_changes,
+                                                opencart_api_url, opencart_api_key, confirm_item, progress)
+
+            # Items with a new ERP revision may have new codes, re-resolve them on next use
+            itemcodes.invalidate_item_codes(changed_items["ids"], changed_items["codes"])
+
+            logger.info(f"Products written: {counts['written']}, unchanged and skipped: {counts['skipped']}, failed: {counts['failed']}.")
+
+            if checkpoint.revision_number is not None:
+                logger.info(f"Revision watermark {checkpoint.revision_number} committed in {checkpoint.writes} writes.")
         else:
             logger.info("All items have been synced!")
 
+        client.log_connection_stats()
     else:
         logger.error("Authentication with ERP failed.")
 
@@ -0,0 +1,45 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from . import jobs
+from .models import SyncSchedule
+
+logger = logging.getLogger(__name__)
+
+
+def load_schedules():
+    """Creates or updates a SyncSchedule row for every sync kind in settings.SYNC_SCHEDULE."""
+    for kind, interval_minutes in getattr(settings, 'SYNC_SCHEDULE', {}).items():
+        if kind not in jobs.SYNC_MODULES:
+            logger.error(f"Unknown sync kind '{kind}' in SYNC_SCHEDULE.")
+            continue
+        schedule, created = SyncSchedule.objects.get_or_create(kind=kind, defaults={'interval_minutes': interval_minutes})
+        if not created and schedule.interval_minutes != interval_minutes:
+            schedule.interval_minutes = interval_minutes
+            schedule.next_run_at = None
+            schedule.save(update_fields=['interval_minutes', 'next_run_at'])
+
+
+def run_due_schedules(now=None):
+    """Queues a job for every enabled schedule that is due and returns the queued jobs.
+
+    Runs missed while the scheduler was down are coalesced into a single
+    catch-up run, after which the schedule continues one interval from now.
+    A schedule whose previous job is still queued or running is not queued
+    again; it is retried on the next tick.
+    """
+    now = now or timezone.now()
+    queued = []
+    for schedule in SyncSchedule.objects.filter(enabled=True):
+        if schedule.next_run_at is not None and schedule.next_run_at > now:
+            continue
+        if jobs.has_pending_job(schedule.kind):
+            continue
+        if schedule.next_run_at is not None and now - schedule.next_run_at >= timedelta(minutes=schedule.interval_minutes):
+            logger.info(f"Catching up on missed {schedule.kind} runs since {schedule.next_run_at:%Y-%m-%d %H:%M}.")
+        queued.append(jobs.enqueue(schedule.kind))
+        schedule.last_run_at = now
+        schedule.next_run_at = now + timedelta(minutes=schedule.interval_minutes)
+        schedule.save(update_fields=['last_run_at', 'next_run_at'])
+    return queued
@@ -119,6 +119,87 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 APPEND_SLASH = False
 
+# Shared HTTP client used for all ERP and OpenCart calls (see Galaxy2Opencart/client.py)
+HTTP_CLIENT = {
+    'pool_connections': 10,
+    'pool_maxsize': 20,
+    'connect_timeout': 10,
+    'read_timeout': 120,
+    'retries': 3,
+    'backoff_factor': 0.5,
+    'status_forcelist': (502, 503, 504),
+    # Seconds the ERP ss-id cookie is reused before logging in again
+    'erp_session_ttl': 1200,
+    # Maximum requests per second per host (0 disables), with per-host overrides
+    'rate_limit': 0,
+    'rate_limits': {},
+}
+
+# Page size used when listing OpenCart products to build the SKU index
+OPENCART_PRODUCTS_PAGE_SIZE = 100
+
+# Number of products written to OpenCart in parallel by the product sync
+PRODUCT_PUSH_WORKERS = 4
+
+# Chunk size in bytes used when streaming large ERP listings
+ERP_STREAM_CHUNK_SIZE = 65536
+
+# Image sync pipeline: worker threads per stage and size of the queues between them
+IMAGE_RESOLVE_WORKERS = 4
+IMAGE_DOWNLOAD_WORKERS = 4
+IMAGE_UPLOAD_WORKERS = 4
+IMAGE_QUEUE_SIZE = 16
+
+# Optional resize/recompress stage of the image sync (requires Pillow).
+# IMAGE_OUTPUT_FORMAT is a Pillow format name such as 'JPEG' (saved progressive) or 'WEBP'.
+IMAGE_PROCESS_ENABLED = False
+IMAGE_PROCESS_WORKERS = 2
+IMAGE_MAX_DIMENSION = 1600
+IMAGE_OUTPUT_FORMAT = 'JPEG'
+IMAGE_QUALITY = 85
+
+# Number of items resolved per ERP item/fetch request
+ERP_ITEM_CODE_BATCH_SIZE = 500
+
+# Order export: orders whose SKUs are resolved in one ERP lookup, and entries posted at once
+ORDER_EXPORT_BATCH_SIZE = 100
+ORDER_EXPORT_WORKERS = 4
+# Failed export attempts after which an order no longer holds back the order watermark
+ORDER_EXPORT_MAX_ATTEMPTS = 5
+
+# Balance sync: SKUs per quantitybysku request, chunks in flight and retries per chunk
+BALANCE_BATCH_SIZE = 500
+BALANCE_PUSH_WORKERS = 4
+BALANCE_CHUNK_RETRIES = 2
+
+# Poll interval and random jitter in seconds of the balance_sync management command
+BALANCE_SYNC_INTERVAL = 30
+BALANCE_SYNC_JITTER = 5
+
+# Seconds an idle run_sync_jobs worker waits before checking the job queue again
+SYNC_JOB_POLL_INTERVAL = 2
+
+# Seconds between checks of the job rows by the /jobs/events/ progress stream, and its lifetime
+SYNC_EVENTS_POLL_INTERVAL = 1
+SYNC_EVENTS_MAX_DURATION = 300
+
+# Minutes between scheduled runs of each sync type (used by the run_scheduler command)
+SYNC_SCHEDULE = {
+    'balance': 5,
+    'orders': 10,
+    'products': 60,
+    'images': 24 * 60,
+    'categories': 24 * 60,
+}
+SCHEDULER_TICK = 30
+
+# Seconds after which a sync lock of a crashed process expires (held locks are refreshed)
+SYNC_LOCK_TTL = 600
+
+# Sync watermarks are committed every N confirmed items or every N seconds
+SYNC_CHECKPOINT_BATCH_SIZE = 200
+SYNC_CHECKPOINT_INTERVAL = 5
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -130,7 +211,13 @@ LOGGING = {
         'json_file': {
             'level': 'INFO',
             'class': 'Galaxy2Opencart.handlers.JsonFileLogHandler',
-            'filename': 'logs.json'
+            'filename': 'logs.json',
+            # Rotate at 10 MB or daily, keeping 5 old files; buffer up to 10000 records
+            'max_bytes': 10 * 1024 * 1024,
+            'backup_count': 5,
+            'rotate_interval': 24 * 60 * 60,
+            'buffer_size': 10000,
+            'flush_interval': 0.5,
         },
     },
     'loggers': {
@@ -163,6 +250,21 @@ LOGGING = {
             'handlers': ['json_file'],
             'level': 'INFO',
             'propagate': True,
+        },
+        'Galaxy2Opencart.jobs': {
+            'handlers': ['json_file'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'Galaxy2Opencart.scheduler': {
+            'handlers': ['json_file'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        'Galaxy2Opencart.client': {
+            'handlers': ['json_file'],
+            'level': 'INFO',
+            'propagate': True,
         }
     }
 }
@@ -12,6 +12,10 @@ urlpatterns = [
     path('answers/', views.answer_form_view, name='answer_form_view'),
     path('messages/', views.get_latest_messages, name='get_latest_messages'),
     path('clear_logs/', views.clear_logs, name='clear_logs'),
+    path('jobs/', views.job_list, name='job_list'),
+    path('jobs/events/', views.job_events, name='job_events'),
+    path('jobs/<int:job_id>/', views.job_status, name='job_status'),
+    path('jobs/<int:job_id>/cancel/', views.cancel_job, name='cancel_job'),
     # Add any other paths you might need for your application.
 ]
 
@@ -1,18 +1,15 @@
-from django.http import JsonResponse
-from . import products
-from . import orders
-from . import categories
-from . import image
-from . import balance
+import time
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from . import handlers, jobs
 from . import init
-from .models import UserAnswer
+from .models import SyncJob, UserAnswer
 from .forms import UserAnswerForm
-from django.shortcuts import render, redirect
+from django.shortcuts import get_object_or_404, render, redirect
 from django.contrib import messages
 from django.http import JsonResponse
 from .models import ConsoleMessage
 from django.views.decorators.csrf import csrf_exempt
-import os
 import json
 from django.http import HttpResponseRedirect
 from django.urls import reverse
@@ -22,16 +19,25 @@ from django.urls import reverse
 def main_page(request):
     return render(request, 'Galaxy2Opencart/main.html')
 
+def enqueue_sync(request, kind, template_name):
+    job = jobs.enqueue(kind)
+    # The main page posts with AJAX and tracks the job itself, a plain form post gets the page back
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return JsonResponse({"job_id": job.pk, "status": job.status})
+    messages.success(request, f'Sync job {job.pk} queued.')
+    return render(request, template_name)
+
 # Products View
 def products_view(request):
-    products.run_import()
+    if request.method == "POST":
+        return enqueue_sync(request, 'products', 'Galaxy2Opencart/products_view.html')
     return render(request, 'Galaxy2Opencart/products_view.html')
 
 
 # Orders View
 def orders_view(request):
     if request.method == "POST":
-        orders.run_import()
+        return enqueue_sync(request, 'orders', 'Galaxy2Opencart/orders_view.html')
     return render(request, 'Galaxy2Opencart/orders_view.html')
 
 # Categories View
@@ -48,27 +54,71 @@ def categories_view(request):
  #           "woo_consumer_key": request.POST.get("woo_consumer_key"),
  #           "woo_consumer_secret": request.POST.get("woo_consumer_secret"),
   #      }
-        results = categories.run_import()
-        if results:
-            messages.success(request, 'Categories imported successfully!')
-        else:
-            messages.error(request, 'There was an error importing categories.')
+        return enqueue_sync(request, 'categories', 'Galaxy2Opencart/categories_view.html')
     return render(request, 'Galaxy2Opencart/categories_view.html')
 
 def image_view(request):
     if request.method == "POST":
-        results = image.run_import()
-        if results:
-            messages.success(request, 'Images imported successfully!')
-        else:
-            messages.error(request, 'There was an error importing images.')
+        return enqueue_sync(request, 'images', 'Galaxy2Opencart/image_view.html')
     return render(request, 'Galaxy2Opencart/image_view.html')
 
 def balance_view(request):
     if request.method == "POST":
-        balance.run_import()
+        return enqueue_sync(request, 'balance', 'Galaxy2Opencart/balance_view.html')
     return render(request, 'Galaxy2Opencart/balance_view.html')
 
+def job_status(request, job_id):
+    job = get_object_or_404(SyncJob, pk=job_id)
+    return JsonResponse(jobs.job_to_dict(job))
+
+def job_list(request):
+    recent_jobs = SyncJob.objects.order_by('-id')[:20]
+    return JsonResponse([jobs.job_to_dict(job) for job in recent_jobs], safe=False)
+
+def job_event_stream(job_id):
+    """Yields an SSE ``job`` event whenever the job row changes.
+
+    The stream ends when the job finished, or after SYNC_EVENTS_MAX_DURATION
+    seconds, when EventSource clients reconnect on their own.
+    """
+    poll_interval = getattr(settings, 'SYNC_EVENTS_POLL_INTERVAL', 1)
+    deadline = time.monotonic() + getattr(settings, 'SYNC_EVENTS_MAX_DURATION', 300)
+    last_sent = {}
+    last_event_at = time.monotonic()
+    yield f"retry: {int(poll_interval * 1000)}\n\n"
+    while time.monotonic() < deadline:
+        for job in SyncJob.objects.filter(pk=job_id):
+            job_data = jobs.job_to_dict(job)
+            if last_sent.get(job.pk) != job_data:
+                last_sent[job.pk] = job_data
+                last_event_at = time.monotonic()
+                yield f"event: job\nid: {job.pk}\ndata: {json.dumps(job_data)}\n\n"
+        if all(data['status'] not in (SyncJob.QUEUED, SyncJob.RUNNING) for data in last_sent.values()):
+            break
+        if time.monotonic() - last_event_at >= 15:
+            # Comment line that keeps proxies from closing an idle stream
+            last_event_at = time.monotonic()
+            yield ": keep-alive\n\n"
+        time.sleep(poll_interval)
+
+
+def job_events(request):
+    job_id = request.GET.get('job', '')
+    if not job_id.isdigit():
+        return JsonResponse({"error": "job required"}, status=400)
+    job = get_object_or_404(SyncJob, pk=int(job_id))
+    response = StreamingHttpResponse(job_event_stream(job.pk), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def cancel_job(request, job_id):
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=405)
+    get_object_or_404(SyncJob, pk=job_id)
+    jobs.request_cancel(job_id)
+    return JsonResponse(jobs.job_to_dict(SyncJob.objects.get(pk=job_id)))
+
 #def init_view(request):
 #    if request.method == "POST":
 #        user_answers = {
@@ -101,15 +151,18 @@ def answer_form_view(request):
     return render(request, 'Galaxy2Opencart/answer_form.html', {'form': form})
 
 def get_latest_messages(request):
-    with open('logs.json', 'r') as f:
-        log_entries = [json.loads(line) for line in f.readlines()]
-    # Optionally filter, paginate, or limit the number of entries you send
-    return JsonResponse(log_entries, safe=False)
+    # Poll with the returned cursor to get only new entries, e.g. /messages/?cursor=...&level=ERROR,WARNING&module=products
+    try:
+        limit = min(max(int(request.GET.get('limit', 200)), 1), 1000)
+    except ValueError:
+        limit = 200
+    levels = {level.upper() for level in request.GET.get('level', '').split(',') if level}
+    modules = {module for module in request.GET.get('module', '').split(',') if module}
+    result = handlers.read_log_entries('logs.json', request.GET.get('cursor'), limit, levels, modules)
+    return JsonResponse(result)
 
 def clear_logs(request):
-    log_file = "logs.json"
-    if os.path.exists(log_file):
-        os.remove(log_file)
+    handlers.clear_log_file("logs.json")
     return HttpResponseRedirect(reverse('main_page'))
 
 